@@ -0,0 +1,92 @@
+import numpy as np
+import torch
+
+
+class EventAugment:
+    def __init__(self, H: int, W: int, flip_p: float = 0., max_shift: int = 0, drop_p: float = 0.,
+                 time_scale: tuple = None, polarity_flip_p: float = 0.):
+        '''
+        :param H: height of the sensor
+        :type H: int
+        :param W: width of the sensor
+        :type W: int
+        :param flip_p: probability to flip the events horizontally
+        :type flip_p: float
+        :param max_shift: the events are shifted by a random offset in ``[-max_shift, max_shift]`` along ``x`` and
+                ``y``. Events shifted out of the sensor are dropped
+        :type max_shift: int
+        :param drop_p: every sample drops a random ratio in ``[0, drop_p)`` of its events
+        :type drop_p: float
+        :param time_scale: a tuple ``(low, high)``. The timestamps are scaled by a random factor in ``[low, high)``
+                around the first event. It only changes the frames when they are integrated with ``split_by='time'``
+        :type time_scale: tuple
+        :param polarity_flip_p: probability to swap the ON and OFF events
+        :type polarity_flip_p: float
+
+        Augment a dict of events whose keys are ``['t', 'x', 'y', 'p']`` before it is integrated into frames, e.g., as
+        the ``event_transform`` of :class:`event_store.EventStore`. Every augmentation is a vectorized operation on the
+        whole event arrays, and all dropped events are removed by one mask at the end. The input arrays are never
+        modified, so they can be read-only views of a memory map.
+
+        The random generator is created in every process from ``torch.initial_seed()``, which the DataLoader sets
+        differently for every worker and derives from ``torch.manual_seed``. The augmentation is thus deterministic
+        under the seed of the training script.
+        '''
+        self.H = H
+        self.W = W
+        self.flip_p = flip_p
+        self.max_shift = max_shift
+        self.drop_p = drop_p
+        self.time_scale = time_scale
+        self.polarity_flip_p = polarity_flip_p
+        self.rng = None
+        self.rng_seed = None
+
+    def _get_rng(self):
+        seed = torch.initial_seed()
+        if self.rng is None or self.rng_seed != seed:
+            self.rng = np.random.default_rng(seed)
+            self.rng_seed = seed
+        return self.rng
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['rng'] = None
+        return state
+
+    def __call__(self, events: dict):
+        rng = self._get_rng()
+        t, p = events['t'], events['p']
+        # astype copies, so x and y can be modified in place
+        x = events['x'].astype(np.int32)
+        y = events['y'].astype(np.int32)
+        mask = None
+
+        if self.flip_p > 0 and rng.random() < self.flip_p:
+            np.subtract(self.W - 1, x, out=x)
+
+        if self.max_shift > 0:
+            dx, dy = rng.integers(-self.max_shift, self.max_shift + 1, size=2)
+            x += dx
+            y += dy
+            mask = (x >= 0) & (x < self.W) & (y >= 0) & (y < self.H)
+
+        if self.drop_p > 0:
+            keep = rng.random(t.size) >= rng.uniform(0, self.drop_p)
+            mask = keep if mask is None else mask & keep
+
+        if self.time_scale is not None and t.size > 0:
+            scale = rng.uniform(self.time_scale[0], self.time_scale[1])
+            t = t[0] + ((t - t[0]) * scale).astype(np.int64)
+
+        if self.polarity_flip_p > 0 and rng.random() < self.polarity_flip_p:
+            p = (p == 0).astype(np.uint8)
+
+        events = {'t': t, 'x': x, 'y': y, 'p': p}
+        if mask is not None:
+            events = {key: value[mask] for key, value in events.items()}
+        return events
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(H={self.H}, W={self.W}, flip_p={self.flip_p}, max_shift={self.max_shift}, ' \
+               f'drop_p={self.drop_p}, time_scale={self.time_scale}, polarity_flip_p={self.polarity_flip_p})'
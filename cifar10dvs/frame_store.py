@@ -0,0 +1,176 @@
+import os
+
+import numpy as np
+import torch
+import torch.utils.data
+
+
+def frames_path(store_dir):
+    return os.path.join(store_dir, 'frames.npy')
+
+
+def labels_path(store_dir):
+    return os.path.join(store_dir, 'labels.npy')
+
+
+def is_packed(store_dir):
+    return os.path.exists(frames_path(store_dir)) and os.path.exists(labels_path(store_dir))
+
+
+def pack_frames(dataset: torch.utils.data.Dataset, store_dir: str, dtype=np.uint8, num_workers: int = 0):
+    '''
+    :param dataset: a frame dataset whose samples are ``(frames, label)`` with ``frames.shape = [T, 2, H, W]``, e.g.,
+            ``DVS128Gesture(data_type='frame')`` or ``CIFAR10DVS(data_type='frame')``
+    :type dataset: torch.utils.data.Dataset
+    :param store_dir: directory to write ``frames.npy`` and ``labels.npy`` to
+    :type store_dir: str
+    :param dtype: an unsigned integer dtype for the frames. Event counts larger than its maximum are saturated
+    :param num_workers: number of workers used to decode the samples of ``dataset``
+    :type num_workers: int
+
+    Pack all samples of ``dataset`` into one ``[N, T, 2, H, W]`` array and one ``[N]`` label array, both in ``.npy``
+    format so that :class:`FrameStore` can memory-map them. ``frames.npy`` is written under a temporary name and
+    renamed at the end, so an interrupted conversion never leaves a store that :func:`is_packed` accepts.
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    max_value = np.iinfo(dtype).max
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+
+    frames = None
+    labels = np.empty([len(dataset)], dtype=np.int64)
+    tmp_path = frames_path(store_dir) + '.tmp'
+    saturated = 0
+    for i, (x, y) in enumerate(data_loader):
+        x = np.asarray(x)
+        if frames is None:
+            frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(dataset),) + x.shape)
+        if x.max() > max_value:
+            saturated += 1
+        frames[i] = np.minimum(x, max_value)
+        labels[i] = int(y)
+
+    frames.flush()
+    del frames
+    np.save(labels_path(store_dir), labels)
+    os.replace(tmp_path, frames_path(store_dir))
+    if saturated > 0:
+        print(f'{saturated} of {labels.shape[0]} samples have been saturated to {max_value}')
+
+
+class FrameStore(torch.utils.data.Dataset):
+    def __init__(self, store_dir: str, frames_number: int = None, transform=None, target_transform=None):
+        '''
+        :param store_dir: directory written by :func:`pack_frames`
+        :type store_dir: str
+        :param frames_number: number of frames of every sample, which must divide the number of stored frames. If it
+                is smaller, the stored frames are summed in contiguous groups of equal size. ``None`` means the stored
+                number
+        :type frames_number: int
+
+        A frame dataset backed by a memory-mapped ``frames.npy``. Samples are zero-copy views of the mapping, so
+        reading one costs no decompression and, after the first epoch, no disk I/O. The mapping is opened lazily so
+        that every DataLoader worker maps the file itself instead of receiving a pickled copy.
+
+        A store packed once at a fine base resolution ``T_base`` thus serves every ``T`` that divides it, e.g.,
+        ``T_base = 240`` serves ``T = 4, 8, 12, 16, 20``. The ``j``-th frame sums the base frames
+        ``[j * T_base // T, (j + 1) * T_base // T)``, so with ``split_by='number'`` it holds the same events as a frame
+        integrated at ``T`` directly, up to fewer than ``T_base`` events at every frame boundary.
+        '''
+        self.store_dir = store_dir
+        self.transform = transform
+        self.target_transform = target_transform
+        self.targets = np.load(labels_path(store_dir))
+        self.frames = None
+
+        self.base_frames_number = np.load(frames_path(store_dir), mmap_mode='r').shape[1]
+        if frames_number is None:
+            frames_number = self.base_frames_number
+        if self.base_frames_number % frames_number != 0:
+            raise ValueError(f'frames_number={frames_number} does not divide the '
+                             f'{self.base_frames_number} stored frames')
+        self.frames_number = frames_number
+        self.group_size = self.base_frames_number // frames_number
+
+    def _get_frames(self):
+        if self.frames is None:
+            # copy-on-write keeps the mapping writable for torch.from_numpy without copying it
+            self.frames = np.load(frames_path(self.store_dir), mmap_mode='c')
+        return self.frames
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['frames'] = None
+        return state
+
+    def __getitem__(self, index):
+        return self.get_sample(index)
+
+    def get_sample(self, index, frame_index=None):
+        '''
+        :param index: index of the sample
+        :type index: int
+        :param frame_index: indices of the frames to read. All frames are read if ``None``
+        :type frame_index: np.ndarray
+        :return: a tuple ``(frames, target)``
+        :rtype: tuple
+
+        Only the base frames of the chosen frames are read from the mapping and summed.
+        '''
+        frames = self._get_frames()[index]
+        if self.group_size > 1:
+            # a view of the mapping with shape = [T, group_size, 2, H, W]
+            frames = frames.reshape((self.frames_number, self.group_size) + frames.shape[1:])
+            if frame_index is not None:
+                frames = frames[frame_index]
+            frames = frames.sum(axis=1, dtype=np.float32)
+        elif frame_index is not None:
+            frames = frames[frame_index]
+        frames = torch.from_numpy(frames)
+        target = int(self.targets[index])
+        if self.transform is not None:
+            frames = self.transform(frames)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return frames, target
+
+    def __len__(self):
+        return self.targets.shape[0]
+
+
+class RandomTemporalSubset(torch.utils.data.Dataset):
+    def __init__(self, dataset: torch.utils.data.Dataset, T_train: int):
+        '''
+        :param dataset: a frame dataset, or a ``Subset`` of it
+        :type dataset: torch.utils.data.Dataset
+        :param T_train: number of frames to keep
+        :type T_train: int
+
+        Keep ``T_train`` frames of every sample, chosen randomly and independently per sample and kept in temporal
+        order. The frames are drawn with the ``torch`` RNG, which the DataLoader seeds differently in every worker.
+        If the underlying dataset is a :class:`FrameStore`, only the chosen frames are read from the mapping;
+        otherwise they are selected right after loading, before collation and transfer to the device. Sparse frames,
+        e.g., from ``EventStore(sparse=True)``, are selected with ``index_select``, as advanced indexing is not
+        implemented for sparse tensors.
+        '''
+        self.dataset = dataset
+        self.T_train = T_train
+
+    def sample_frame_index(self, frames_number):
+        return torch.randperm(frames_number)[0: self.T_train].sort().values.numpy()
+
+    def __getitem__(self, index):
+        dataset = self.dataset
+        while isinstance(dataset, torch.utils.data.Subset):
+            dataset, index = dataset.dataset, dataset.indices[index]
+
+        if isinstance(dataset, FrameStore):
+            return dataset.get_sample(index, self.sample_frame_index(dataset.frames_number))
+
+        frames, target = dataset[index]
+        frame_index = self.sample_frame_index(frames.shape[0])
+        if frames.is_sparse:
+            return frames.index_select(0, torch.from_numpy(frame_index)).coalesce(), target
+        return frames[frame_index], target
+
+    def __len__(self):
+        return len(self.dataset)
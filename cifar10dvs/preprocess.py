@@ -0,0 +1,155 @@
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import tqdm
+from spikingjelly.datasets import cifar10_dvs, np_savez
+
+import event_store
+
+
+def save_npz_atomic(file_name: str, **arrays):
+    '''
+    Save ``arrays`` to a temporary file and rename it to ``file_name``, so ``file_name`` never holds a partial file.
+    The temporary name does not end with ``.npz``, so it is never read as a sample.
+    '''
+    tmp_name = file_name + '.tmp'
+    with open(tmp_name, 'wb') as f:
+        np_savez(f, **arrays)
+    os.replace(tmp_name, file_name)
+
+
+def is_valid_events_file(file_name: str):
+    try:
+        with np.load(file_name) as f:
+            lengths = {f[key].shape for key in ('t', 'x', 'y', 'p')}
+    except Exception:
+        return False
+    return lengths.__len__() == 1
+
+
+def is_valid_frames_file(file_name: str, shape: tuple):
+    try:
+        with np.load(file_name) as f:
+            return f['frames'].shape == shape
+    except Exception:
+        return False
+
+
+def convert_aedat_file(aedat_file: str, events_file: str):
+    '''
+    Convert one recording to ``events_file`` in the same way as ``CIFAR10DVS.read_aedat_save_to_np``. It does nothing
+    if ``events_file`` exists and can be loaded.
+
+    :return: the number of written samples
+    :rtype: int
+    '''
+    if is_valid_events_file(events_file):
+        return 0
+    events = cifar10_dvs.CIFAR10DVS.load_origin_data(aedat_file)
+    save_npz_atomic(events_file, t=events['t'], x=events['x'], y=events['y'], p=events['p'])
+    return 1
+
+
+def convert_events_file(events_file: str, frames_file: str, T: int, split_by: str, H: int, W: int):
+    '''
+    Integrate one events file to ``frames_file``. It does nothing if ``frames_file`` exists and can be loaded.
+
+    :return: the number of written samples
+    :rtype: int
+    '''
+    if is_valid_frames_file(frames_file, (T, 2, H, W)):
+        return 0
+    with np.load(events_file) as f:
+        events = {key: f[key] for key in ('t', 'x', 'y', 'p')}
+    save_npz_atomic(frames_file, frames=event_store.integrate_events_to_frames(events, T, H, W, split_by))
+    return 1
+
+
+def run_jobs(pool, func, jobs: list, desc: str):
+    converted = 0
+    with tqdm.tqdm(total=jobs.__len__(), desc=desc, unit='file') as pbar:
+        for n in pool.imap_unordered(func, jobs):
+            converted += n
+            pbar.update()
+    print(f'{desc}: {converted} samples are written, and the others already exist.')
+
+
+def _convert_aedat_file(job):
+    return convert_aedat_file(*job)
+
+
+def _convert_events_file(job):
+    return convert_events_file(*job)
+
+
+def finish_dir(work_dir: str, target_dir: str):
+    if work_dir != target_dir:
+        os.replace(work_dir, target_dir)
+        print(f'Rename [{work_dir}] to [{target_dir}].')
+
+
+def get_work_dir(target_dir: str):
+    # spikingjelly uses any existing directory as finished, so a new directory is built under a temporary name
+    return target_dir if os.path.exists(target_dir) else target_dir + '.tmp'
+
+
+def create_events_np(root: str, pool):
+    extract_root = os.path.join(root, 'extract')
+    events_np_root = os.path.join(root, 'events_np')
+    work_dir = get_work_dir(events_np_root)
+
+    jobs = []
+    for class_name in os.listdir(extract_root):
+        aedat_dir = os.path.join(extract_root, class_name)
+        np_dir = os.path.join(work_dir, class_name)
+        os.makedirs(np_dir, exist_ok=True)
+        for bin_file in os.listdir(aedat_dir):
+            jobs.append((os.path.join(aedat_dir, bin_file), os.path.join(np_dir, os.path.splitext(bin_file)[0] + '.npz')))
+
+    run_jobs(pool, _convert_aedat_file, jobs, 'events_np')
+    finish_dir(work_dir, events_np_root)
+    return events_np_root
+
+
+def create_frames_np(root: str, events_np_root: str, T: int, split_by: str, pool):
+    H, W = cifar10_dvs.CIFAR10DVS.get_H_W()
+    frames_np_root = os.path.join(root, f'frames_number_{T}_split_by_{split_by}')
+    work_dir = get_work_dir(frames_np_root)
+
+    jobs = []
+    for e_root, e_dirs, e_files in os.walk(events_np_root):
+        output_dir = os.path.join(work_dir, os.path.relpath(e_root, events_np_root))
+        os.makedirs(output_dir, exist_ok=True)
+        for e_file in e_files:
+            if e_file.endswith('.npz'):
+                jobs.append((os.path.join(e_root, e_file), os.path.join(output_dir, e_file), T, split_by, H, W))
+
+    run_jobs(pool, _convert_events_file, jobs, os.path.basename(frames_np_root))
+    finish_dir(work_dir, frames_np_root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert CIFAR10-DVS to the npz files of spikingjelly in parallel')
+    parser.add_argument('-data_dir', type=str, default='D:/1/dataset',
+                        help='root dir of CIFAR10-DVS, which contains the extracted recordings in extract')
+    parser.add_argument('-T', default=[16], type=int, nargs='+', help='simulating time-steps, e.g., -T 16 20')
+    parser.add_argument('-split_by', default='number', type=str, help='number or time')
+    parser.add_argument('-j', default=os.cpu_count(), type=int, metavar='N',
+                        help='number of processes (default: the number of cpus)')
+
+    args = parser.parse_args()
+    print(args)
+
+    st = time.time()
+    with multiprocessing.Pool(args.j) as pool:
+        events_np_root = create_events_np(args.data_dir, pool)
+        for T in args.T:
+            create_frames_np(args.data_dir, events_np_root, T, args.split_by, pool)
+    print('Took', time.time() - st)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 import os
 import time
 import torch
@@ -11,6 +12,11 @@ import sys
 from torch.cuda import amp
 # import smodels_firing_num
 import smodels
+import event_augment
+import event_store
+import frame_pack
+import frame_store
+import utils
 import argparse
 from spikingjelly.clock_driven import functional
 from spikingjelly.datasets import cifar10_dvs
@@ -39,8 +45,47 @@ def get_parameter_number(net):
     return {'Total': total_num, 'Trainable': trainable_num}
 
 
+def get_label_index(dataset: torch.utils.data.Dataset):
+    '''
+    :param dataset: the dataset
+    :type dataset: torch.utils.data.Dataset
+    :return: the labels of all samples
+    :rtype: np.ndarray
+
+    Read the labels from the dataset metadata, i.e., ``targets`` of ``DatasetFolder`` based datasets such as
+    ``CIFAR10DVS`` (which come from the file paths) or of :class:`frame_store.FrameStore`, so that no sample is
+    decoded. Only datasets without such metadata fall back to iterating over all samples.
+    '''
+    if isinstance(dataset, torch.utils.data.Subset):
+        return get_label_index(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    if hasattr(dataset, 'targets'):
+        return np.asarray(dataset.targets, dtype=np.int64)
+    if hasattr(dataset, 'samples'):
+        return np.asarray([item[1] for item in dataset.samples], dtype=np.int64)
+
+    labels = np.empty([len(dataset)], dtype=np.int64)
+    for i, item in enumerate(dataset):
+        y = item[1]
+        if isinstance(y, np.ndarray) or isinstance(y, torch.Tensor):
+            y = y.item()
+        labels[i] = y
+    return labels
+
+
+def split_fingerprint(labels: np.ndarray, train_ratio: float, num_classes: int, random_split: bool):
+    '''
+    :return: a digest of the sample labels and of the split arguments
+
+    The digest identifies the sample list rather than the frames, so it is the same for every ``T`` and for a
+    :class:`frame_store.FrameStore` packed from the same dataset.
+    '''
+    h = hashlib.sha1(np.ascontiguousarray(labels, dtype=np.int64).tobytes())
+    h.update(f'{train_ratio}_{num_classes}_{random_split}'.encode())
+    return h.hexdigest()
+
+
 def split_to_train_test_set(train_ratio: float, origin_dataset: torch.utils.data.Dataset, num_classes: int,
-                            random_split: bool = False):
+                            random_split: bool = False, index_cache: str = None):
     '''
     :param train_ratio: split the ratio of the origin dataset as the train set
     :type train_ratio: float
@@ -53,30 +98,55 @@ def split_to_train_test_set(train_ratio: float, origin_dataset: torch.utils.data
             If ``True``, this function will split samples in each classes randomly. The randomness is controlled by
             ``numpy.randon.seed``
     :type random_split: int
+    :param index_cache: path of a ``.npz`` file that caches the split indices together with their
+            :func:`split_fingerprint`. The cache is rebuilt if the fingerprint does not match
+    :type index_cache: str
     :return: a tuple ``(train_set, test_set)``
     :rtype: tuple
-    '''
-    label_idx = []
-    for i in range(num_classes):
-        label_idx.append([])
 
-    for i, item in enumerate(origin_dataset):
-        y = item[1]
-        if isinstance(y, np.ndarray) or isinstance(y, torch.Tensor):
-            y = y.item()
-        label_idx[y].append(i)
-    train_idx = []
-    test_idx = []
-    if random_split:
+    The labels are read by :func:`get_label_index`, so no sample is decoded to split the dataset.
+    '''
+    labels = get_label_index(origin_dataset)
+    fingerprint = split_fingerprint(labels, train_ratio, num_classes, random_split)
+    index = None
+    if index_cache is not None and os.path.exists(index_cache):
+        index = np.load(index_cache)
+        if str(index['fingerprint']) != fingerprint:
+            print(f'{index_cache} does not match the dataset, rebuild it')
+            index = None
+
+    if index is not None:
+        train_idx, test_idx = index['train_idx'], index['test_idx']
+    else:
+        train_idx = []
+        test_idx = []
         for i in range(num_classes):
-            np.random.shuffle(label_idx[i])
+            label_idx = np.flatnonzero(labels == i)
+            if random_split:
+                np.random.shuffle(label_idx)
+            pos = math.ceil(label_idx.size * train_ratio)
+            train_idx.append(label_idx[0: pos])
+            test_idx.append(label_idx[pos:])
+        train_idx = np.concatenate(train_idx)
+        test_idx = np.concatenate(test_idx)
+
+        if index_cache is not None:
+            os.makedirs(os.path.dirname(index_cache), exist_ok=True)
+            np.savez(index_cache, train_idx=train_idx, test_idx=test_idx, fingerprint=fingerprint)
 
-    for i in range(num_classes):
-        pos = math.ceil(label_idx[i].__len__() * train_ratio)
-        train_idx.extend(label_idx[i][0: pos])
-        test_idx.extend(label_idx[i][pos: label_idx[i].__len__()])
+    return torch.utils.data.Subset(origin_dataset, train_idx.tolist()), \
+        torch.utils.data.Subset(origin_dataset, test_idx.tolist())
 
-    return torch.utils.data.Subset(origin_dataset, train_idx), torch.utils.data.Subset(origin_dataset, test_idx)
+
+def prefetch(data_loader, device):
+    '''
+    Yield the batches of ``data_loader`` on ``device``. The frames are copied, unpacked and cast to float32 in a
+    background thread by ``utils.DevicePrefetcher``, so the loop does not wait on the copy.
+    '''
+    def convert(batch):
+        frames, labels = batch
+        return frame_pack.to_device(frames, device), labels.to(device, non_blocking=True)
+    return utils.DevicePrefetcher(data_loader, device, convert)
 
 
 def main():
@@ -105,26 +175,78 @@ def main():
     parser.add_argument('-T_max', default=64, type=int, help='T_max for CosineAnnealingLR')
     parser.add_argument('-model', default='SEWResNet', type=str)
     parser.add_argument('-cnf', default='ADD', type=str)
+    parser.add_argument('-global_pool', action='store_true',
+                        help='average the spikes over the space before the classifier, so the model takes any resolution')
+    parser.add_argument('-tile_size', type=int, default=None,
+                        help='test on overlapping tiles of this size with smodels.tiled_forward, for frames larger than '
+                             'the model takes, e.g., 346x260. Tiles other than 128 need global_pool')
     parser.add_argument('-T_train', default=None, type=int)
     parser.add_argument('-dts_cache', type=str, default='./dts_cache')
+    parser.add_argument('-frame_store', type=str, default=None,
+                        help='dir of the memory-mapped frame store, which is packed from data_dir on first use')
+    parser.add_argument('-frame_store_T', type=int, default=None,
+                        help='number of frames that the frame store is packed with, e.g., 240. Any T that divides it '
+                             'is derived by summing contiguous frames. The default is T')
+    parser.add_argument('-event_store', type=str, default=None,
+                        help='dir of the memory-mapped event store, which is packed from data_dir on first use. '
+                             'Frames are integrated for any T when loading, and frame_store is ignored')
+    parser.add_argument('-event_augment', action='store_true',
+                        help='augment the training events before integration. It requires event_store')
+    parser.add_argument('-sparse_input', action='store_true',
+                        help='feed the frames as sparse tensors, and the first layer runs as a sparse-dense product '
+                             'without materializing the dense frames. It requires event_store')
+    parser.add_argument('-pack_frames', action='store_true',
+                        help='send the frames from the data loading workers to the device as bitmasks and uint8 counts, '
+                             'which are unpacked on the device. Counts larger than 255 are saturated')
+    parser.add_argument('-duration', type=int, default=None,
+                        help='integrate the events into frames of this duration in microseconds, rather than into T '
+                             'frames. The number of frames varies with the sample, and the padded steps are ignored by '
+                             'the model. It requires event_store, and T_train is ignored')
 
     args = parser.parse_args()
     print(args)
 
-    train_set_pth = os.path.join(args.dts_cache, f'train_set_{args.T}.pt')
-    test_set_pth = os.path.join(args.dts_cache, f'test_set_{args.T}.pt')
-    if os.path.exists(train_set_pth) and os.path.exists(test_set_pth):
-        train_set = torch.load(train_set_pth)
-        test_set = torch.load(test_set_pth)
+    split_index_pth = os.path.join(args.dts_cache, 'split_index.npz')
+    if args.event_store:
+        if not event_store.is_packed(args.event_store):
+            print(f'Packing events to {args.event_store}')
+            H, W = cifar10_dvs.CIFAR10DVS.get_H_W()
+            event_store.pack_events(cifar10_dvs.CIFAR10DVS(root=args.data_dir, data_type='event'), args.event_store,
+                                    H, W, num_workers=args.j)
+        origin_set = event_store.EventStore(args.event_store, args.T, sparse=args.sparse_input,
+                                            duration=args.duration)
+    elif args.frame_store:
+        # coarser T are derived from a store packed with more frames
+        store_T = args.T if args.frame_store_T is None else args.frame_store_T
+        store_dir = os.path.join(args.frame_store, f'T{store_T}')
+        if not frame_store.is_packed(store_dir):
+            print(f'Packing frames to {store_dir}')
+            frame_store.pack_frames(cifar10_dvs.CIFAR10DVS(root=args.data_dir, data_type='frame', frames_number=store_T,
+                                                           split_by='number'), store_dir, num_workers=args.j)
+        origin_set = frame_store.FrameStore(store_dir, args.T)
     else:
         origin_set = cifar10_dvs.CIFAR10DVS(root=args.data_dir, data_type='frame', frames_number=args.T,
                                             split_by='number')
 
-        train_set, test_set = split_to_train_test_set(0.9, origin_set, 10)
-        if not os.path.exists(args.dts_cache):
-            os.makedirs(args.dts_cache)
-        torch.save(train_set, train_set_pth)
-        torch.save(test_set, test_set_pth)
+    train_set, test_set = split_to_train_test_set(0.9, origin_set, 10, index_cache=split_index_pth)
+    if args.event_store and args.event_augment:
+        H, W = cifar10_dvs.CIFAR10DVS.get_H_W()
+        event_transform = event_augment.EventAugment(H, W, flip_p=0.5, max_shift=16, drop_p=0.1)
+        print(event_transform)
+        train_set = torch.utils.data.Subset(
+            event_store.EventStore(args.event_store, args.T, event_transform=event_transform, sparse=args.sparse_input,
+                                   duration=args.duration), train_set.indices)
+    if args.T_train and not args.duration:
+        # subsampling frames would break the time grid of the frames with fixed duration
+        train_set = frame_store.RandomTemporalSubset(train_set, args.T_train)
+
+    collate_fn = None
+    if args.duration:
+        collate_fn = frame_pack.padded_collate_fn
+    elif args.sparse_input:
+        collate_fn = event_store.sparse_collate_fn
+    elif args.pack_frames:
+        collate_fn = frame_pack.packed_collate_fn
 
     train_data_loader = DataLoader(
         dataset=train_set,
@@ -132,7 +254,8 @@ def main():
         shuffle=True,
         num_workers=args.j,
         drop_last=True,
-        pin_memory=True)
+        pin_memory=not args.sparse_input,
+        collate_fn=collate_fn)
 
     test_data_loader = DataLoader(
         dataset=test_set,
@@ -140,7 +263,8 @@ def main():
         shuffle=False,
         num_workers=args.j,
         drop_last=False,
-        pin_memory=True)
+        pin_memory=not args.sparse_input,
+        collate_fn=collate_fn)
 
     scaler = None
     if args.amp:
@@ -149,7 +273,7 @@ def main():
     start_epoch = 0
     max_test_acc = 0
 
-    net = smodels.__dict__[args.model](args.cnf)
+    net = smodels.__dict__[args.model](args.cnf, global_pool=args.global_pool)
     print(net)
     print(get_parameter_number(net))
     net.to(args.device)
@@ -197,6 +321,9 @@ def main():
     if args.amp:
         out_dir += '_amp'
 
+    if args.global_pool:
+        out_dir += '_gpool'
+
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
         print(f'Mkdir {out_dir}.')
@@ -223,16 +350,17 @@ def main():
     save_path = './firing'
 
     with torch.no_grad():
-        for frame, label in test_data_loader:
-            frame = frame.float().to(args.device)
-            label = label.to(args.device)
-            out_fr, firing_num  = net(frame)
+        for frame, label in prefetch(test_data_loader, args.device):
+            if args.tile_size:
+                out_fr, firing_num = smodels.tiled_forward(net, frame, args.tile_size)
+            else:
+                out_fr, firing_num  = net(frame)
 
             lists = []
             for firing_single in firing_num:
                 sub_list = []
                 firing_single = firing_single.cpu().detach().numpy()
-                for T_ in range(args.T):
+                for T_ in range(firing_single.shape[0]):
                     sub_list.append(np.sum(firing_single[T_, :, :, :, :]))
                 sub_list.append(firing_single[0, :, :, :, :].shape[0] * firing_single[0, :, :, :, :].shape[1] *
                                 firing_single[0, :, :, :, :].shape[2] * firing_single[0, :, :, :, :].shape[3])
@@ -263,16 +391,8 @@ def main():
     #     train_loss = 0
     #     train_acc = 0
     #     train_samples = 0
-    #     for frame, label in train_data_loader:
+    #     for frame, label in prefetch(train_data_loader, args.device):
     #         optimizer.zero_grad()
-    #         frame = frame.float().to(args.device)
-    #
-    #         if args.T_train:
-    #             sec_list = np.random.choice(frame.shape[1], args.T_train, replace=False)
-    #             sec_list.sort()
-    #             frame = frame[:, sec_list]
-    #
-    #         label = label.to(args.device)
     #         if args.amp:
     #             with amp.autocast():
     #                 out_fr = net(frame)
@@ -303,9 +423,7 @@ def main():
     #     test_acc = 0
     #     test_samples = 0
     #     with torch.no_grad():
-    #         for frame, label in test_data_loader:
-    #             frame = frame.float().to(args.device)
-    #             label = label.to(args.device)
+    #         for frame, label in prefetch(test_data_loader, args.device):
     #             out_fr = net(frame)
     #             loss = F.cross_entropy(out_fr, label)
     #
@@ -0,0 +1,111 @@
+import queue
+import threading
+
+import torch
+
+
+def to_device(data, device):
+    '''
+    Move every tensor in ``data``, which can be a tensor or nested tuples, namedtuples and lists of tensors, to
+    ``device`` without blocking. A dense CPU tensor is pinned first if it is not, so the copy is asynchronous.
+    '''
+    if isinstance(data, torch.Tensor):
+        if device.type == 'cuda' and data.device.type == 'cpu' and not data.is_sparse and not data.is_pinned():
+            data = data.pin_memory()
+        return data.to(device, non_blocking=True)
+    if isinstance(data, tuple) and hasattr(data, '_fields'):
+        return type(data)(*[to_device(x, device) for x in data])
+    if isinstance(data, (tuple, list)):
+        return type(data)(to_device(x, device) for x in data)
+    return data
+
+
+def record_stream(data, stream):
+    # tell the caching allocator that the tensors made on the side stream are used on ``stream``
+    if isinstance(data, torch.Tensor):
+        if data.is_sparse:
+            record_stream((data._indices(), data._values()), stream)
+        elif data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, (tuple, list)):
+        for x in data:
+            record_stream(x, stream)
+
+
+class DevicePrefetcher(object):
+    '''
+    Wrap ``data_loader`` to yield batches that are already on ``device``. A background thread takes the batches from
+    ``data_loader`` and calls ``convert`` on them, which moves them to ``device`` and casts them to the dtype or layout
+    that the model takes, and at most ``depth`` converted batches wait in a queue. On CUDA, ``convert`` runs on a side
+    stream, and the current stream of the consumer only waits on an event of the copy, so the host never waits on the
+    copy. On CPU, the conversion still runs in the background thread, while the main thread computes the last batch.
+
+    :param data_loader: an iterable of batches with ``__len__``, e.g., ``torch.utils.data.DataLoader``
+    :param device: the device of the batches
+    :param convert: a function that takes a batch from ``data_loader`` and returns the batch on ``device``. The
+            default is :func:`to_device`
+    :type convert: callable
+    :param depth: the number of converted batches that can wait in the queue
+    :type depth: int
+    '''
+    def __init__(self, data_loader, device, convert=None, depth=2):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        if convert is None:
+            def convert(batch):
+                return to_device(batch, self.device)
+        self.convert = convert
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _produce(self, batches: queue.Queue, stream, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self.data_loader:
+                if stream is None:
+                    item = (self.convert(batch), None)
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = self.convert(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    item = (batch, event)
+                if not put(item):
+                    return
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stream, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    record_stream(batch, current_stream)
+                yield batch
+        finally:
+            # stop the thread if the consumer breaks early
+            stop.set()
+            thread.join()
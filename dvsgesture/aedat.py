@@ -0,0 +1,179 @@
+import os
+
+import numpy as np
+
+# the 28 bytes header of every packet in AEDAT 3.1
+PACKET_HEADER_DTYPE = np.dtype([
+    ('type', '<u2'), ('source', '<u2'), ('size', '<u4'), ('offset', '<u4'), ('tsoverflow', '<u4'),
+    ('capacity', '<u4'), ('number', '<u4'), ('valid', '<u4')
+])
+POLARITY_EVENT = 1
+
+
+def find_data_start(mm: np.ndarray):
+    '''
+    :param mm: the whole file as a ``uint8`` array
+    :type mm: np.ndarray
+    :return: the offset of the first packet, which is after the ascii header ``#...\\r\\n`` lines
+    :rtype: int
+    '''
+    pos = 0
+    while pos < mm.size and mm[pos] == ord('#'):
+        end = pos
+        # the header is short, so it is scanned in small pieces rather than by loading the whole file
+        while True:
+            piece = np.asarray(mm[end: end + 256])
+            newline = np.flatnonzero(piece == ord('\n'))
+            if newline.size > 0:
+                end += int(newline[0]) + 1
+                break
+            if piece.size == 0:
+                return mm.size
+            end += piece.size
+        line = bytes(mm[pos: end])
+        pos = end
+        if line.startswith(b'#!END-HEADER'):
+            break
+    return pos
+
+
+def decode_polarity_events(data: np.ndarray, size: int, tsoverflow: int):
+    '''
+    :param data: bytes of the events of one packet as a ``uint8`` array
+    :type data: np.ndarray
+    :param size: bytes of one event
+    :type size: int
+    :param tsoverflow: the timestamp overflow counter in the packet header
+    :type tsoverflow: int
+    :return: a dict whose keys are ``['t', 'x', 'y', 'p']`` and values are ``np.ndarray``
+    :rtype: dict
+
+    A vectorized version of the loop in ``spikingjelly.datasets.load_aedat_v3``.
+    '''
+    words = data[0: data.size // size * size].reshape(-1, size)[:, 0: 8].copy().view('<u4')
+    aer_data = words[:, 0]
+    return {
+        't': words[:, 1].astype(np.int64) | (int(tsoverflow) << 31),
+        'x': ((aer_data >> 17) & 0x00007FFF).astype(np.uint16),
+        'y': ((aer_data >> 2) & 0x00007FFF).astype(np.uint16),
+        'p': ((aer_data >> 1) & 0x00000001).astype(np.uint8)
+    }
+
+
+def concatenate_events(blocks: list):
+    return {key: np.concatenate([block[key] for block in blocks]) for key in ('t', 'x', 'y', 'p')}
+
+
+def iter_aedat_v3(file_name: str, chunk_size: int = 1 << 20):
+    '''
+    :param file_name: path of the aedat v3 file
+    :type file_name: str
+    :param chunk_size: the minimal number of events in every yielded block, except for the last one
+    :type chunk_size: int
+    :return: a generator of dicts whose keys are ``['t', 'x', 'y', 'p']`` and values are ``np.ndarray``
+
+    Read the polarity events of an AEDAT 3.1 file, e.g., a recording of DVS128 Gesture, as blocks of about
+    ``chunk_size`` events. The file is memory-mapped and only the packets of the current block are decoded, so the
+    memory does not grow with the length of the recording. Non-polarity packets are skipped, as
+    ``spikingjelly.datasets.load_aedat_v3`` does, and the concatenated blocks equal the dict returned by it.
+    '''
+    if os.path.getsize(file_name) == 0:
+        return
+    mm = np.memmap(file_name, dtype=np.uint8, mode='r')
+    pos = find_data_start(mm)
+    blocks = []
+    events_number = 0
+    while pos + PACKET_HEADER_DTYPE.itemsize <= mm.size:
+        header = mm[pos: pos + PACKET_HEADER_DTYPE.itemsize].view(PACKET_HEADER_DTYPE)[0]
+        pos += PACKET_HEADER_DTYPE.itemsize
+        data_length = int(header['capacity']) * int(header['size'])
+        if header['type'] == POLARITY_EVENT and data_length > 0:
+            block = decode_polarity_events(mm[pos: pos + data_length], int(header['size']), header['tsoverflow'])
+            blocks.append(block)
+            events_number += block['t'].size
+            if events_number >= chunk_size:
+                yield concatenate_events(blocks)
+                blocks = []
+                events_number = 0
+        pos += data_length
+    if events_number > 0:
+        yield concatenate_events(blocks)
+
+
+def load_label_csv(csv_file: str):
+    '''
+    :return: an array with ``shape = [N, 3]`` whose rows are ``(label, t_start, t_end)``, and the labels start from 0
+    :rtype: np.ndarray
+    '''
+    csv_data = np.loadtxt(csv_file, dtype=np.int64, delimiter=',', skiprows=1, ndmin=2)
+    # the label of DVS128 Gesture is 1, 2, ..., 11. We set 0 as the first label, rather than 1
+    csv_data[:, 0] -= 1
+    return csv_data
+
+
+def slice_by_labels(blocks, windows: np.ndarray):
+    '''
+    :param blocks: an iterable of event dicts sorted by time, e.g., :func:`iter_aedat_v3`
+    :param windows: rows of ``(label, t_start, t_end)``, e.g., :func:`load_label_csv`
+    :type windows: np.ndarray
+    :return: a generator of ``(events, label)`` in the order of ``windows``
+
+    A sample takes the events with ``t_start <= t < t_end`` as ``DVS128Gesture.split_aedat_files_to_np`` does, and
+    the windows may overlap. Only the events that may still belong to an unfinished window are buffered, and a
+    window is yielded as soon as the stream passes its ``t_end``.
+    '''
+    buffer = []
+    i = 0
+
+    def select(events, mask):
+        return {key: value[mask] for key, value in events.items()}
+
+    for block in blocks:
+        if i == windows.shape[0]:
+            break
+        if block['t'].size == 0:
+            continue
+        t_last = block['t'][-1]
+        # drop the events before all unfinished windows
+        buffer.append(select(block, block['t'] >= windows[i:, 1].min()))
+        if t_last < windows[i, 2]:
+            continue
+        events = concatenate_events(buffer)
+        while i < windows.shape[0] and t_last >= windows[i, 2]:
+            label, t_start, t_end = windows[i]
+            yield select(events, (events['t'] >= t_start) & (events['t'] < t_end)), int(label)
+            i += 1
+        if i < windows.shape[0]:
+            buffer = [select(events, events['t'] >= windows[i:, 1].min())]
+
+    if i < windows.shape[0]:
+        # the stream ends before the last windows are finished
+        events = concatenate_events(buffer) if buffer else {key: np.empty([0], dtype=np.int64) for key in 'txyp'}
+        for label, t_start, t_end in windows[i:]:
+            yield select(events, (events['t'] >= t_start) & (events['t'] < t_end)), int(label)
+
+
+def iter_dvs128_gesture(aedat_dir: str, train: bool, chunk_size: int = 1 << 20):
+    '''
+    :param aedat_dir: the extracted ``DvsGesture`` directory, which contains the ``.aedat`` recordings, their
+            ``_labels.csv`` files and ``trials_to_train.txt``/``trials_to_test.txt``
+    :type aedat_dir: str
+    :param train: read the train split or the test split
+    :type train: bool
+    :param chunk_size: see :func:`iter_aedat_v3`
+    :type chunk_size: int
+    :return: a generator of ``(events, label)`` of all samples in the split
+
+    Stream the samples of DVS128 Gesture from the raw recordings without the per-sample ``.npz`` files of
+    ``DVS128Gesture``, e.g., for :func:`event_store.pack_event_samples`. Any recording in AEDAT 3.1 with a label
+    csv file in the same format can be read in the same way.
+    '''
+    trials_txt = os.path.join(aedat_dir, 'trials_to_train.txt' if train else 'trials_to_test.txt')
+    with open(trials_txt) as f:
+        fnames = [line.strip() for line in f.readlines()]
+    for fname in fnames:
+        if fname.__len__() == 0:
+            continue
+        aedat_file = os.path.join(aedat_dir, fname)
+        windows = load_label_csv(os.path.join(aedat_dir, os.path.splitext(fname)[0] + '_labels.csv'))
+        yield from slice_by_labels(iter_aedat_v3(aedat_file, chunk_size), windows)
@@ -0,0 +1,94 @@
+import collections
+
+import numpy as np
+import torch
+
+# bits: np.packbits of ``frames != 0`` in a flat uint8 tensor
+# counts: uint8 values of the nonzero pixels in the row-major order, which is empty if all frames are binary
+# shape: the shape of the stacked frames as an int64 tensor
+PackedFrames = collections.namedtuple('PackedFrames', ['bits', 'counts', 'shape'])
+# frames: frames padded with zeros to the longest sample, with shape = [N, T, 2, H, W]
+# lengths: number of valid frames of every sample
+PaddedFrames = collections.namedtuple('PaddedFrames', ['frames', 'lengths'])
+
+
+def pack_frames(frames: np.ndarray):
+    '''
+    :param frames: frames of event counts in any dtype
+    :type frames: np.ndarray
+    :return: the packed frames
+    :rtype: PackedFrames
+
+    Pack ``frames`` into a bitmask of the nonzero pixels, which is 32 times smaller than float32 frames. If any pixel
+    counts more than one event, the counts of the nonzero pixels are appended as uint8 and saturated at 255, which is
+    also the maximum of ``frame_store.pack_frames`` with the default dtype.
+    '''
+    mask = frames != 0
+    bits = np.packbits(mask.reshape(-1))
+    if frames.max(initial=0) > 1:
+        counts = np.minimum(frames[mask], 255).astype(np.uint8)
+    else:
+        counts = np.empty([0], dtype=np.uint8)
+    return PackedFrames(torch.from_numpy(bits), torch.from_numpy(counts), torch.as_tensor(frames.shape))
+
+
+def packed_collate_fn(batch):
+    '''
+    Collate samples whose frames are dense ``[T, 2, H, W]`` counts into :class:`PackedFrames` and a label tensor. Pass
+    it as ``collate_fn`` of the DataLoader, so the workers send the packed frames to the main process and
+    ``pin_memory`` only copies the packed frames. Use :func:`to_device` to unpack them.
+    '''
+    frames, targets = zip(*batch)
+    frames = np.stack([np.asarray(x) for x in frames])
+    return pack_frames(frames), torch.as_tensor(targets)
+
+
+def padded_collate_fn(batch):
+    '''
+    Collate samples whose frames have different numbers of frames, e.g., from ``EventStore(duration=...)``, into
+    :class:`PaddedFrames` and a label tensor. Pass it as ``collate_fn`` of the DataLoader. ``ResNetN`` takes the
+    :class:`PaddedFrames` and ignores the padded steps.
+    '''
+    frames, targets = zip(*batch)
+    lengths = torch.as_tensor([x.shape[0] for x in frames])
+    padded = torch.zeros([len(frames), int(lengths.max())] + list(frames[0].shape[1:]), dtype=frames[0].dtype)
+    for i, x in enumerate(frames):
+        padded[i, 0: x.shape[0]] = torch.as_tensor(x)
+    return PaddedFrames(padded, lengths), torch.as_tensor(targets)
+
+
+def unpack_frames(packed: PackedFrames, device, dtype=torch.float32):
+    '''
+    :param packed: frames packed by :func:`pack_frames`
+    :type packed: PackedFrames
+    :param device: device to unpack the frames on
+    :param dtype: dtype of the unpacked frames
+    :return: the dense frames
+    :rtype: torch.Tensor
+
+    Only the packed frames are copied to ``device``, and the frames are unpacked and cast there. The counts are
+    gathered by the running number of nonzero pixels rather than by boolean indexing, so it does not synchronize
+    with the device.
+    '''
+    shape = torch.Size(packed.shape.tolist())
+    bits = packed.bits.to(device, non_blocking=True)
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=bits.device)
+    mask = ((bits.unsqueeze(1) >> shifts) & 1).flatten()[0: shape.numel()].bool()
+    if packed.counts.numel() == 0:
+        return mask.to(dtype).view(shape)
+    counts = packed.counts.to(device, non_blocking=True).to(dtype)
+    index = (torch.cumsum(mask, 0) - 1).clamp_(min=0)
+    return torch.where(mask, counts[index], torch.zeros([], dtype=dtype, device=bits.device)).view(shape)
+
+
+def to_device(frames, device, dtype=torch.float32):
+    '''
+    Move a batch of frames from the DataLoader to ``device`` and cast it to ``dtype``. ``frames`` can be
+    :class:`PackedFrames` from :func:`packed_collate_fn`, :class:`PaddedFrames` from :func:`padded_collate_fn`, or a
+    dense or sparse tensor.
+    '''
+    if isinstance(frames, PackedFrames):
+        return unpack_frames(frames, device, dtype)
+    if isinstance(frames, PaddedFrames):
+        return PaddedFrames(to_device(frames.frames, device, dtype), frames.lengths.to(device, non_blocking=True))
+    return frames.to(device, non_blocking=True).to(dtype)
@@ -0,0 +1,131 @@
+import argparse
+import time
+
+import torch
+import torch.utils.data
+from spikingjelly.clock_driven import functional
+from spikingjelly.datasets import dvs128_gesture
+from torch import nn
+
+import smodels
+import train
+import utils
+
+
+def parse_checkpoint(entry: str, args):
+    '''
+    :param entry: ``PATH`` of a checkpoint saved by ``train.py``, whose ``args`` tell the model, or
+            ``MODEL[:CONNECT_F]=PATH`` for a checkpoint without ``args``
+    :type entry: str
+    :return: the path, the model name, ``connect_f``, ``global_pool`` and the state dict
+    '''
+    if '=' in entry:
+        spec, path = entry.split('=', 1)
+    else:
+        spec, path = None, entry
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    if spec is not None:
+        model_name, _, connect_f = spec.partition(':')
+        global_pool = args.global_pool
+    elif 'args' in checkpoint:
+        model_name, connect_f = checkpoint['args'].model, checkpoint['args'].connect_f
+        global_pool = getattr(checkpoint['args'], 'global_pool', False)
+    else:
+        raise ValueError(f'{path} has no args, use MODEL[:CONNECT_F]={path}')
+    state_dict = checkpoint['model'] if 'model' in checkpoint else checkpoint
+    return path, model_name, connect_f or None, global_pool, state_dict
+
+
+def evaluate_models(models: list, data_loader, device, print_freq=100):
+    '''
+    :param models: the models to evaluate
+    :type models: list
+    :return: ``[(loss, acc1, acc5)]`` of every model
+
+    Feed every batch of ``data_loader`` to all ``models``, so the frames are loaded and copied to ``device`` once
+    rather than once for every model. The sums of the metrics stay on the device until all batches are done.
+    '''
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    # the sum of the loss, the number of top-1 and top-5 correct samples of every model
+    sums = torch.zeros([len(models), 3], dtype=torch.float64, device=device)
+    num_samples = 0
+    with torch.no_grad():
+        for image, target in metric_logger.log_every(train.prefetch(data_loader, device), print_freq, 'Test:'):
+            for i, model in enumerate(models):
+                output = model(image)
+                functional.reset_net(model)
+                correct = output.topk(5, 1)[1] == target.unsqueeze(1)
+                sums[i] += torch.stack([nn.functional.cross_entropy(output, target, reduction='sum'),
+                                        correct[:, 0].sum(), correct.sum()]).double()
+            num_samples += target.shape[0]
+
+    sums = torch.cat([sums.flatten(), sums.new_tensor([num_samples])])
+    if utils.is_dist_avail_and_initialized():
+        sums = utils.all_gather_flat(sums).sum(0)
+    sums = sums.tolist()
+    num_samples = max(sums.pop(), 1)
+    return [(sums[3 * i] / num_samples, sums[3 * i + 1] * 100. / num_samples, sums[3 * i + 2] * 100. / num_samples)
+            for i in range(len(models))]
+
+
+def main(args):
+    utils.init_distributed_mode(args)
+    print(args)
+    device = torch.device(args.device)
+
+    models = []
+    for entry in args.checkpoints:
+        path, model_name, connect_f, global_pool, state_dict = parse_checkpoint(entry, args)
+        model = smodels.__dict__[model_name](connect_f, global_pool=global_pool)
+        train.load_state_dict_by_order(model, state_dict)
+        model.to(device)
+        model.eval()
+        models.append(model)
+        print(f'{path}: {model_name}, connect_f={connect_f}, global_pool={global_pool}')
+
+    st = time.time()
+    dataset_test = dvs128_gesture.DVS128Gesture(root=args.data_path, train=False, data_type='frame',
+                                                frames_number=args.T, split_by='number')
+    print("Took", time.time() - st)
+    if args.distributed:
+        test_sampler = utils.ShardedSampler(dataset_test)
+    else:
+        test_sampler = torch.utils.data.SequentialSampler(dataset_test)
+    data_loader_test = torch.utils.data.DataLoader(
+        dataset_test, batch_size=args.batch_size,
+        sampler=test_sampler, num_workers=args.workers, pin_memory=True)
+
+    results = evaluate_models(models, data_loader_test, device, args.print_freq)
+    lines = ['checkpoint,loss,acc1,acc5']
+    for entry, (loss, acc1, acc5) in zip(args.checkpoints, results):
+        print(f'{entry}: Acc@1 = {acc1}, Acc@5 = {acc5}, loss = {loss}')
+        lines.append(f'{entry},{loss},{acc1},{acc5}')
+    if args.output_csv and utils.is_main_process():
+        with open(args.output_csv, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Evaluate many checkpoints with one pass of the test set')
+
+    parser.add_argument('checkpoints', nargs='+',
+                        help='checkpoints saved by train.py, or MODEL[:CONNECT_F]=PATH for other checkpoints, '
+                             'e.g., SEWResNet:ADD=./add.pth SEWResNet:IAND=./iand.pth PlainNet=./plain.pth')
+    parser.add_argument('--data-path', default='D:/1/dataset/DVS128Gesture', help='dataset')
+    parser.add_argument('--device', default='cpu', help='device')
+    parser.add_argument('-b', '--batch-size', default=16, type=int)
+    parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                        help='number of data loading workers (default: 4)')
+    parser.add_argument('--print-freq', default=64, type=int, help='print frequency')
+    parser.add_argument('--T', default=16, type=int, help='simulation steps')
+    parser.add_argument('--global-pool', action='store_true', help='global_pool of MODEL=PATH')
+    parser.add_argument('--output-csv', default=None, help='save the metrics of all checkpoints to this csv file')
+    parser.add_argument('--dist-url', default='env://', help='url used to set up distributed evaluation')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,176 @@
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import tqdm
+from spikingjelly.datasets import dvs128_gesture, np_savez
+
+import aedat
+import event_store
+
+NUM_CLASSES = 11
+
+
+def save_npz_atomic(file_name: str, **arrays):
+    '''
+    Save ``arrays`` to a temporary file and rename it to ``file_name``, so ``file_name`` never holds a partial file.
+    The temporary name does not end with ``.npz``, so it is never read as a sample.
+    '''
+    tmp_name = file_name + '.tmp'
+    with open(tmp_name, 'wb') as f:
+        np_savez(f, **arrays)
+    os.replace(tmp_name, file_name)
+
+
+def is_valid_events_file(file_name: str):
+    try:
+        with np.load(file_name) as f:
+            lengths = {f[key].shape for key in ('t', 'x', 'y', 'p')}
+    except Exception:
+        return False
+    return lengths.__len__() == 1
+
+
+def is_valid_frames_file(file_name: str, shape: tuple):
+    try:
+        with np.load(file_name) as f:
+            return f['frames'].shape == shape
+    except Exception:
+        return False
+
+
+def convert_recording(aedat_file: str, csv_file: str, output_dir: str):
+    '''
+    Split one recording to the samples ``{output_dir}/{label}/{fname}_{k}.npz`` in the same way as
+    ``DVS128Gesture.split_aedat_files_to_np``. It does nothing if all samples exist and can be loaded.
+
+    :return: the number of written samples
+    :rtype: int
+    '''
+    fname = os.path.splitext(os.path.basename(aedat_file))[0]
+    windows = aedat.load_label_csv(csv_file)
+    # many samples of a recording can have the same label, e.g., user26_fluorescent_labels.csv
+    label_file_num = [0] * NUM_CLASSES
+    file_names = []
+    for label in windows[:, 0]:
+        file_names.append(os.path.join(output_dir, str(label), f'{fname}_{label_file_num[label]}.npz'))
+        label_file_num[label] += 1
+
+    if all(is_valid_events_file(file_name) for file_name in file_names):
+        return 0
+    for file_name, (events, label) in zip(file_names, aedat.slice_by_labels(aedat.iter_aedat_v3(aedat_file), windows)):
+        save_npz_atomic(file_name, t=events['t'], x=events['x'], y=events['y'], p=events['p'])
+    return file_names.__len__()
+
+
+def convert_events_file(events_file: str, frames_file: str, T: int, split_by: str, H: int, W: int):
+    '''
+    Integrate one events file to ``frames_file``. It does nothing if ``frames_file`` exists and can be loaded.
+
+    :return: the number of written samples
+    :rtype: int
+    '''
+    if is_valid_frames_file(frames_file, (T, 2, H, W)):
+        return 0
+    with np.load(events_file) as f:
+        events = {key: f[key] for key in ('t', 'x', 'y', 'p')}
+    save_npz_atomic(frames_file, frames=event_store.integrate_events_to_frames(events, T, H, W, split_by))
+    return 1
+
+
+def run_jobs(pool, func, jobs: list, desc: str):
+    converted = 0
+    with tqdm.tqdm(total=jobs.__len__(), desc=desc, unit='file') as pbar:
+        for n in pool.imap_unordered(func, jobs):
+            converted += n
+            pbar.update()
+    print(f'{desc}: {converted} samples are written, and the others already exist.')
+
+
+def _convert_recording(job):
+    return convert_recording(*job)
+
+
+def _convert_events_file(job):
+    return convert_events_file(*job)
+
+
+def finish_dir(work_dir: str, target_dir: str):
+    if work_dir != target_dir:
+        os.replace(work_dir, target_dir)
+        print(f'Rename [{work_dir}] to [{target_dir}].')
+
+
+def get_work_dir(target_dir: str):
+    # spikingjelly uses any existing directory as finished, so a new directory is built under a temporary name
+    return target_dir if os.path.exists(target_dir) else target_dir + '.tmp'
+
+
+def create_events_np(root: str, pool):
+    aedat_dir = os.path.join(root, 'extract', 'DvsGesture')
+    events_np_root = os.path.join(root, 'events_np')
+    work_dir = get_work_dir(events_np_root)
+
+    jobs = []
+    for split in ('train', 'test'):
+        for label in range(NUM_CLASSES):
+            os.makedirs(os.path.join(work_dir, split, str(label)), exist_ok=True)
+        with open(os.path.join(aedat_dir, f'trials_to_{split}.txt')) as trials_txt:
+            for fname in trials_txt.readlines():
+                fname = fname.strip()
+                if fname.__len__() > 0:
+                    jobs.append((os.path.join(aedat_dir, fname),
+                                 os.path.join(aedat_dir, os.path.splitext(fname)[0] + '_labels.csv'),
+                                 os.path.join(work_dir, split)))
+
+    run_jobs(pool, _convert_recording, jobs, 'events_np')
+    finish_dir(work_dir, events_np_root)
+    return events_np_root
+
+
+def create_frames_np(root: str, events_np_root: str, T: int, split_by: str, pool):
+    H, W = dvs128_gesture.DVS128Gesture.get_H_W()
+    frames_np_root = os.path.join(root, f'frames_number_{T}_split_by_{split_by}')
+    work_dir = get_work_dir(frames_np_root)
+
+    jobs = []
+    for e_root, e_dirs, e_files in os.walk(events_np_root):
+        output_dir = os.path.join(work_dir, os.path.relpath(e_root, events_np_root))
+        os.makedirs(output_dir, exist_ok=True)
+        for e_file in e_files:
+            if e_file.endswith('.npz'):
+                jobs.append((os.path.join(e_root, e_file), os.path.join(output_dir, e_file), T, split_by, H, W))
+
+    run_jobs(pool, _convert_events_file, jobs, os.path.basename(frames_np_root))
+    finish_dir(work_dir, frames_np_root)
+
+
+def main(args):
+    print(args)
+    st = time.time()
+    with multiprocessing.Pool(args.workers) as pool:
+        events_np_root = create_events_np(args.data_path, pool)
+        for T in args.T:
+            create_frames_np(args.data_path, events_np_root, T, args.split_by, pool)
+    print('Took', time.time() - st)
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert DVS128 Gesture to the npz files of spikingjelly in parallel')
+
+    parser.add_argument('--data-path', default='D:/1/dataset/DVS128Gesture',
+                        help='dataset, which contains the extracted recordings in extract/DvsGesture')
+    parser.add_argument('--T', default=[16], type=int, nargs='+', help='simulation steps, e.g., --T 16 20')
+    parser.add_argument('--split-by', default='number', help='number or time')
+    parser.add_argument('-j', '--workers', default=os.cpu_count(), type=int, metavar='N',
+                        help='number of processes (default: the number of cpus)')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -2,11 +2,61 @@ import torch
 import torch.nn as nn
 from spikingjelly.clock_driven.neuron import MultiStepParametricLIFNode
 # import spikingjelly.clock_driven.neuron.MultiStepParametricLIFNode
-from spikingjelly.clock_driven import layer
+from spikingjelly.clock_driven import functional, layer
+
+class SeqToANNContainer(layer.SeqToANNContainer):
+    '''
+    A ``layer.SeqToANNContainer`` that only computes the valid steps of a padded time batch. ``ResNetN`` sets
+    ``valid_index``, the indices of the valid steps in the flattened ``[T, N]`` dims, during its forward, and the
+    padded steps of the output are zeros. Its parameters are the same as ``layer.SeqToANNContainer``, so the
+    checkpoints are compatible.
+    '''
+    valid_index = None
+
+    def forward(self, x_seq: torch.Tensor):
+        if self.valid_index is None:
+            return super().forward(x_seq)
+        T, N = x_seq.shape[0: 2]
+        y = super().forward(x_seq.flatten(0, 1).index_select(0, self.valid_index).unsqueeze(0)).squeeze(0)
+        out = y.new_zeros([T * N] + list(y.shape[1:]))
+        return out.index_copy(0, self.valid_index, y).view([T, N] + list(y.shape[1:]))
+
+def set_valid_index(net: nn.Module, valid_index):
+    for m in net.modules():
+        if isinstance(m, SeqToANNContainer):
+            m.valid_index = valid_index
+
+def valid_steps(lengths: torch.Tensor, T: int):
+    # a bool mask of the valid steps with shape = [T, N]
+    return torch.arange(T, device=lengths.device).unsqueeze(1) < lengths.unsqueeze(0)
+
+def padded_forward(net: nn.Module, x, valid: torch.Tensor):
+    '''
+    :param net: a net whose stateless layers are wrapped by :class:`SeqToANNContainer`
+    :type net: nn.Module
+    :param x: the input of ``net``, which is a padded time batch with ``shape = [T, N, *]``
+    :param valid: a bool mask of the valid steps with ``shape = [T, N]``, see :func:`valid_steps`
+    :type valid: torch.Tensor
+    :return: ``net(x)``
+
+    The stateless layers skip the padded steps, so they neither cost time nor change the statistics of the batch
+    normalization. The padded steps of a sample all come after its valid steps, so the neurons never feed them
+    into the valid steps.
+    '''
+    set_valid_index(net, valid.flatten().nonzero().squeeze(1))
+    try:
+        return net(x)
+    finally:
+        set_valid_index(net, None)
+
+def valid_mean(x: torch.Tensor, valid: torch.Tensor):
+    # the mean over the valid steps of x with shape = [T, N, *]
+    valid = valid.view(list(valid.shape) + [1] * (x.dim() - 2))
+    return (x * valid).sum(0) / valid.sum(0)
 
 def conv3x3(in_channels, out_channels):
     return nn.Sequential(
-        layer.SeqToANNContainer(
+        SeqToANNContainer(
             nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1, stride=1, bias=False),
             nn.BatchNorm2d(out_channels),
         ),
@@ -15,13 +65,44 @@ def conv3x3(in_channels, out_channels):
 
 def conv1x1(in_channels, out_channels):
     return nn.Sequential(
-        layer.SeqToANNContainer(
+        SeqToANNContainer(
             nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=1, bias=False),
             nn.BatchNorm2d(out_channels),
         ),
         MultiStepParametricLIFNode(init_tau=2.0, detach_reset=True)
     )
 
+def sparse_input_conv(x: torch.Tensor, conv: nn.Conv2d):
+    '''
+    :param x: a sparse COO tensor with ``shape = [N, T, C, H, W]``
+    :type x: torch.Tensor
+    :param conv: a convolutional layer with ``stride=1``, ``dilation=1``, ``groups=1`` and no bias
+    :type conv: nn.Conv2d
+    :return: ``conv`` applied to every time step of ``x`` with ``shape = [T, N, C_out, H_out, W_out]``
+    :rtype: torch.Tensor
+
+    Every nonzero input scatters ``value * conv.weight[:, c, ky, kx]`` into the output pixels it contributes to with
+    ``index_add_``, so the cost is proportional to the number of events and the dense input is never materialized.
+    '''
+    assert conv.stride == (1, 1) and conv.dilation == (1, 1) and conv.groups == 1 and conv.bias is None
+    N, T, C, H, W = x.shape
+    kh, kw = conv.kernel_size
+    ph, pw = conv.padding
+    H_out, W_out = H + 2 * ph - kh + 1, W + 2 * pw - kw + 1
+
+    x = x.coalesce()
+    n, t, c, y, x_ = x.indices()
+    values = x.values().to(conv.weight.dtype)
+    out = torch.zeros([T * N * H_out * W_out, conv.out_channels], dtype=conv.weight.dtype, device=conv.weight.device)
+    for ky in range(kh):
+        for kx in range(kw):
+            oy = y + ph - ky
+            ox = x_ + pw - kx
+            mask = (oy >= 0) & (oy < H_out) & (ox >= 0) & (ox < W_out)
+            position = ((t[mask] * N + n[mask]) * H_out + oy[mask]) * W_out + ox[mask]
+            out.index_add_(0, position, values[mask].unsqueeze(1) * conv.weight[:, c[mask], ky, kx].t())
+    return out.view(T, N, H_out, W_out, conv.out_channels).permute(0, 1, 4, 2, 3)
+
 class SEWBlock(nn.Module):
     def __init__(self, in_channels, mid_channels, connect_f=None):
         super(SEWBlock, self).__init__()
@@ -61,7 +142,7 @@ class BasicBlock(nn.Module):
         self.conv = nn.Sequential(
             conv3x3(in_channels, mid_channels),
 
-            layer.SeqToANNContainer(
+            SeqToANNContainer(
                 nn.Conv2d(mid_channels, in_channels, kernel_size=3, padding=1, stride=1, bias=False),
                 nn.BatchNorm2d(in_channels),
             ),
@@ -73,7 +154,7 @@ class BasicBlock(nn.Module):
 
 
 class ResNetN(nn.Module):
-    def __init__(self, layer_list, num_classes, connect_f=None):
+    def __init__(self, layer_list, num_classes, connect_f=None, global_pool=False):
         super(ResNetN, self).__init__()
         in_channels = 2
         conv = []
@@ -113,27 +194,105 @@ class ResNetN(nn.Module):
 
             if 'k_pool' in cfg_dict:
                 k_pool = cfg_dict['k_pool']
-                conv.append(layer.SeqToANNContainer(nn.MaxPool2d(k_pool, k_pool)))
+                conv.append(SeqToANNContainer(nn.MaxPool2d(k_pool, k_pool)))
 
+        if global_pool:
+            # averaging the spikes over the space makes the net take frames of any resolution
+            conv.append(SeqToANNContainer(nn.AdaptiveAvgPool2d(1)))
         conv.append(nn.Flatten(2))
 
         self.conv = nn.Sequential(*conv)
 
-        with torch.no_grad():
-            x = torch.zeros([1, 1, 128, 128])
-            for m in self.conv.modules():
-                if isinstance(m, nn.MaxPool2d):
-                    x = m(x)
-            out_features = x.numel() * in_channels
+        if global_pool:
+            out_features = in_channels
+        else:
+            with torch.no_grad():
+                x = torch.zeros([1, 1, 128, 128])
+                for m in self.conv.modules():
+                    if isinstance(m, nn.MaxPool2d):
+                        x = m(x)
+                out_features = x.numel() * in_channels
 
         self.out = nn.Linear(out_features, num_classes, bias=True)
 
-    def forward(self, x: torch.Tensor):
-        x = x.permute(1, 0, 2, 3, 4)  # [T, N, 2, *, *]
-        x = self.conv(x)
+    def sparse_input(self, x: torch.Tensor):
+        # the first stage is the conv1x1 or conv3x3 that raises the 2 input channels
+        stage = self.conv[0]
+        for m in stage.modules():
+            if isinstance(m, nn.Conv2d):
+                conv = m
+            elif isinstance(m, nn.BatchNorm2d):
+                bn = m
+        x = sparse_input_conv(x, conv)  # [T, N, C, *, *]
+        x = bn(x.flatten(0, 1)).view(x.shape)
+        return stage[1](x)
+
+    def forward(self, x):
+        if isinstance(x, tuple):
+            # a padded time batch (frames, lengths) with variable T, see frame_pack.padded_collate_fn
+            x, lengths = x
+            x = x.permute(1, 0, 2, 3, 4)  # [T, N, 2, *, *]
+            valid = valid_steps(lengths, x.shape[0])
+            x = padded_forward(self.conv, x, valid)
+            return self.out(valid_mean(x, valid))
+        if x.is_sparse:
+            # a sparse [N, T, 2, *, *] input skips the dense frames, see sparse_input_conv
+            x = self.sparse_input(x)
+            x = self.conv[1:](x)
+        else:
+            x = x.permute(1, 0, 2, 3, 4)  # [T, N, 2, *, *]
+            x = self.conv(x)
         return self.out(x.mean(0))
 
-def SEWResNet(connect_f):
+def tile_starts(size: int, tile_size: int, overlap: int):
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, tile_size - overlap))
+    starts.append(size - tile_size)
+    return starts
+
+def tiled_forward(net: nn.Module, x: torch.Tensor, tile_size: int = 128, overlap: int = 32, tiles_per_batch: int = 8):
+    '''
+    :param net: a :class:`ResNetN`, or a ``smodels_firing_num.ResNetN`` that returns ``(out, firing_num)``
+    :type net: nn.Module
+    :param x: frames with ``shape = [N, T, 2, H, W]``
+    :type x: torch.Tensor
+    :param tile_size: height and width of the tiles
+    :type tile_size: int
+    :param overlap: number of pixels shared by two neighbouring tiles
+    :type overlap: int
+    :param tiles_per_batch: number of tiles that run in one forward
+    :type tiles_per_batch: int
+    :return: the mean output of all tiles with ``shape = [N, num_classes]``, or ``(out, firing_num)`` if ``net``
+            returns a tuple, where the spikes of every layer in ``firing_num`` are summed over the tiles
+
+    Run ``net`` on frames from a large sensor, e.g., 346x260 or 640x480, by splitting them into overlapping tiles.
+    ``tiles_per_batch`` tiles of all samples are stacked along the batch dim and run together, so the memory is
+    bounded by the tile size rather than the sensor size. The net is reset after every forward. The head is linear,
+    so the mean output equals the head applied to the mean pooled features of the tiles. A net with
+    ``global_pool=True`` takes tiles of any size, and other nets need the ``tile_size`` they are built for, i.e., 128.
+    '''
+    N = x.shape[0]
+    tiles = [(i, j) for i in tile_starts(x.shape[-2], tile_size, overlap)
+             for j in tile_starts(x.shape[-1], tile_size, overlap)]
+    out = 0.
+    firing_num = None
+    for k in range(0, tiles.__len__(), tiles_per_batch):
+        batch = torch.cat([x[..., i: i + tile_size, j: j + tile_size] for i, j in tiles[k: k + tiles_per_batch]])
+        y = net(batch)
+        functional.reset_net(net)
+        if isinstance(y, tuple):
+            y, firing = y
+            # [T, tiles * N, C, H, W] -> [T, N, C, H, W]
+            firing = [f.view(f.shape[0], -1, N, *f.shape[2:]).sum(1) for f in firing]
+            firing_num = firing if firing_num is None else [a + b for a, b in zip(firing_num, firing)]
+        out = out + y.view(-1, N, y.shape[-1]).sum(0)
+    out = out / tiles.__len__()
+    if firing_num is None:
+        return out
+    return out, firing_num
+
+def SEWResNet(connect_f, global_pool=False):
     layer_list = [
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'sew', 'k_pool': 2},
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'sew', 'k_pool': 2},
@@ -144,9 +303,9 @@ def SEWResNet(connect_f):
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'sew', 'k_pool': 2},
     ]
     num_classes = 11
-    return ResNetN(layer_list, num_classes, connect_f)
+    return ResNetN(layer_list, num_classes, connect_f, global_pool)
 
-def PlainNet(*args, **kwargs):
+def PlainNet(*args, global_pool=False, **kwargs):
     layer_list = [
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'plain', 'k_pool': 2},
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'plain', 'k_pool': 2},
@@ -157,9 +316,9 @@ def PlainNet(*args, **kwargs):
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'plain', 'k_pool': 2},
     ]
     num_classes = 11
-    return ResNetN(layer_list, num_classes)
+    return ResNetN(layer_list, num_classes, global_pool=global_pool)
 
-def SpikingResNet(*args, **kwargs):
+def SpikingResNet(*args, global_pool=False, **kwargs):
     layer_list = [
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'basic', 'k_pool': 2},
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'basic', 'k_pool': 2},
@@ -170,4 +329,4 @@ def SpikingResNet(*args, **kwargs):
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'basic', 'k_pool': 2},
     ]
     num_classes = 11
-    return ResNetN(layer_list, num_classes)
+    return ResNetN(layer_list, num_classes, global_pool=global_pool)
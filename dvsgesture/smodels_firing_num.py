@@ -4,6 +4,8 @@ from spikingjelly.clock_driven.neuron import MultiStepParametricLIFNode
 # import spikingjelly.clock_driven.neuron.MultiStepParametricLIFNode
 from spikingjelly.clock_driven import layer
 
+import smodels
+
 
 # def conv3x3(in_channels, out_channels):
 #     return nn.Sequential(
@@ -26,7 +28,7 @@ from spikingjelly.clock_driven import layer
 class conv3x3(nn.Module):
     def __init__(self, in_channels, out_channels):
         super(conv3x3, self).__init__()
-        self.layer = layer.SeqToANNContainer(
+        self.layer = smodels.SeqToANNContainer(
             nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1, stride=1, bias=False),
             nn.BatchNorm2d(out_channels),
         )
@@ -42,7 +44,7 @@ class conv3x3(nn.Module):
 class conv1x1(nn.Module):
     def __init__(self, in_channels, out_channels):
         super(conv1x1, self).__init__()
-        self.layer = layer.SeqToANNContainer(
+        self.layer = smodels.SeqToANNContainer(
             nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=1, bias=False),
             nn.BatchNorm2d(out_channels),
         )
@@ -58,7 +60,17 @@ class conv1x1(nn.Module):
 class pool(nn.Module):
     def __init__(self, k_pool):
         super(pool, self).__init__()
-        self.layer = layer.SeqToANNContainer(nn.MaxPool2d(k_pool, k_pool))
+        self.layer = smodels.SeqToANNContainer(nn.MaxPool2d(k_pool, k_pool))
+
+    def forward(self, x):
+        out = self.layer(x[0])
+        return out, x[1]
+
+
+class gpool(nn.Module):
+    def __init__(self):
+        super(gpool, self).__init__()
+        self.layer = smodels.SeqToANNContainer(nn.AdaptiveAvgPool2d(1))
 
     def forward(self, x):
         out = self.layer(x[0])
@@ -137,7 +149,7 @@ class BN(nn.Module):
         super(BN, self).__init__()
         # self.layer1 = nn.Conv2d(mid_channels, in_channels, kernel_size=3, padding=1, stride=1, bias=False)
         # self.layer2 = nn.BatchNorm2d(in_channels)
-        self.layer1 = layer.SeqToANNContainer(
+        self.layer1 = smodels.SeqToANNContainer(
             nn.Conv2d(mid_channels, in_channels, kernel_size=3, padding=1, stride=1, bias=False),
             nn.BatchNorm2d(in_channels),
         )
@@ -232,7 +244,7 @@ class BasicBlock(nn.Module):
 #         x = self.conv(x)
 #         return self.out(x.mean(0))
 class ResNetN(nn.Module):
-    def __init__(self, layer_list, num_classes, connect_f=None):
+    def __init__(self, layer_list, num_classes, connect_f=None, global_pool=False):
         super(ResNetN, self).__init__()
         in_channels = 2
         conv = []
@@ -274,29 +286,56 @@ class ResNetN(nn.Module):
                 # conv.append(layer.SeqToANNContainer(nn.MaxPool2d(k_pool, k_pool)))
                 conv.append(pool(k_pool))
 
+        if global_pool:
+            # averaging the spikes over the space makes the net take frames of any resolution
+            conv.append(gpool())
         # conv.append(nn.Flatten(2))
         conv.append(flatt())
 
         self.conv = nn.Sequential(*conv)
 
-        with torch.no_grad():
-            x = torch.zeros([1, 1, 128, 128])
-            for m in self.conv.modules():
-                if isinstance(m, nn.MaxPool2d):
-                    x = m(x)
-            out_features = x.numel() * in_channels
+        if global_pool:
+            out_features = in_channels
+        else:
+            with torch.no_grad():
+                x = torch.zeros([1, 1, 128, 128])
+                for m in self.conv.modules():
+                    if isinstance(m, nn.MaxPool2d):
+                        x = m(x)
+                out_features = x.numel() * in_channels
 
         self.out = nn.Linear(out_features, num_classes, bias=True)
 
     def forward(self, x):
-        x = x.permute(1, 0, 2, 3, 4)  # [T, N, 2, *, *]
         firing_num = []
-        out = self.conv((x, firing_num))
+        if isinstance(x, tuple):
+            # a padded time batch (frames, lengths) with variable T, see frame_pack.padded_collate_fn
+            x, lengths = x
+            x = x.permute(1, 0, 2, 3, 4)  # [T, N, 2, *, *]
+            valid = smodels.valid_steps(lengths, x.shape[0])
+            out = smodels.padded_forward(self.conv, (x, firing_num), valid)
+            return self.out(smodels.valid_mean(out[0], valid)), out[1]
+        if x.is_sparse:
+            # a sparse [N, T, 2, *, *] input skips the dense frames, see smodels.sparse_input_conv
+            first = self.conv[0]
+            for m in first.layer.modules():
+                if isinstance(m, nn.Conv2d):
+                    conv = m
+                elif isinstance(m, nn.BatchNorm2d):
+                    bn = m
+            x = smodels.sparse_input_conv(x, conv)  # [T, N, C, *, *]
+            x = bn(x.flatten(0, 1)).view(x.shape)
+            x = first.MSPLIF(x)
+            firing_num.append(x)
+            out = self.conv[1:]((x, firing_num))
+        else:
+            x = x.permute(1, 0, 2, 3, 4)  # [T, N, 2, *, *]
+            out = self.conv((x, firing_num))
         x = self.out(out[0].mean(0))
         return x, out[1]
 
 
-def SEWResNet(connect_f):
+def SEWResNet(connect_f, global_pool=False):
     layer_list = [
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'sew', 'k_pool': 2},
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'sew', 'k_pool': 2},
@@ -307,10 +346,10 @@ def SEWResNet(connect_f):
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'sew', 'k_pool': 2},
     ]
     num_classes = 11
-    return ResNetN(layer_list, num_classes, connect_f)
+    return ResNetN(layer_list, num_classes, connect_f, global_pool)
 
 
-def PlainNet(*args, **kwargs):
+def PlainNet(*args, global_pool=False, **kwargs):
     layer_list = [
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'plain', 'k_pool': 2},
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'plain', 'k_pool': 2},
@@ -321,10 +360,10 @@ def PlainNet(*args, **kwargs):
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'plain', 'k_pool': 2},
     ]
     num_classes = 11
-    return ResNetN(layer_list, num_classes)
+    return ResNetN(layer_list, num_classes, global_pool=global_pool)
 
 
-def SpikingResNet(*args, **kwargs):
+def SpikingResNet(*args, global_pool=False, **kwargs):
     layer_list = [
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'basic', 'k_pool': 2},
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'basic', 'k_pool': 2},
@@ -335,4 +374,4 @@ def SpikingResNet(*args, **kwargs):
         {'channels': 32, 'up_kernel_size': 1, 'mid_channels': 32, 'num_blocks': 1, 'block_type': 'basic', 'k_pool': 2},
     ]
     num_classes = 11
-    return ResNetN(layer_list, num_classes)
+    return ResNetN(layer_list, num_classes, global_pool=global_pool)
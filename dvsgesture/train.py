@@ -3,15 +3,19 @@ import math
 import os
 import time
 
-import pandas as pd
 import torch
 import torch.utils.data
 from spikingjelly.clock_driven import functional
 from spikingjelly.datasets import dvs128_gesture
 from torch import nn
 from torch.cuda import amp
-from torch.utils.tensorboard import SummaryWriter
 
+import aedat
+import event_augment
+import event_store
+import frame_pack
+import frame_store
+import smodels
 import smodels_firing_num
 import utils
 
@@ -30,23 +34,30 @@ import numpy as np
 np.random.seed(_seed_)
 
 
-def train_one_epoch(model, criterion, optimizer, data_loader, device, epoch, print_freq, scaler=None, T_train=None):
+def prefetch(data_loader, device):
+    '''
+    Yield the batches of ``data_loader`` on ``device``. The frames are copied, unpacked and cast to float32 in a
+    background thread by ``utils.DevicePrefetcher``, so the loop does not wait on the copy.
+    '''
+    def convert(batch):
+        frames, targets = batch
+        return frame_pack.to_device(frames, device), targets.to(device, non_blocking=True)
+    return utils.DevicePrefetcher(data_loader, device, convert)
+
+
+def train_one_epoch(model, criterion, optimizer, data_loader, device, epoch, print_freq, scaler=None):
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value}'))
     metric_logger.add_meter('img/s', utils.SmoothedValue(window_size=10, fmt='{value}'))
+    # registered up front, so a process without batches still has them in synchronize_between_processes
+    for name in ['loss', 'acc1', 'acc5']:
+        metric_logger.add_meter(name, utils.SmoothedValue())
 
     header = 'Epoch: [{}]'.format(epoch)
 
-    for image, target in metric_logger.log_every(data_loader, print_freq, header):
-        start_time = time.time()
-        image, target = image.to(device), target.to(device)
-        image = image.float()  # [N, T, C, H, W]
-
-        if T_train:
-            sec_list = np.random.choice(image.shape[1], T_train, replace=False)
-            sec_list.sort()
-            image = image[:, sec_list]
+    for image, target in metric_logger.log_every(prefetch(data_loader, device), print_freq, header):
+        # image.shape = [N, T, C, H, W]
 
         if scaler is not None:
             with amp.autocast():
@@ -70,41 +81,42 @@ def train_one_epoch(model, criterion, optimizer, data_loader, device, epoch, pri
         functional.reset_net(model)
 
         acc1, acc5 = utils.accuracy(output, target, topk=(1, 5))
-        batch_size = image.shape[0]
-        loss_s = loss.item()
-        if math.isnan(loss_s):
-            raise ValueError('loss is Nan')
-        acc1_s = acc1.item()
-        acc5_s = acc5.item()
+        batch_size = target.shape[0]
+        # the metrics stay on the device until log_every reads them back every print_freq steps
+        metric_logger.update_on_device(loss=loss, check_nan=True)
+        metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
-        metric_logger.update(loss=loss_s, lr=optimizer.param_groups[0]["lr"])
-
-        metric_logger.meters['acc1'].update(acc1_s, n=batch_size)
-        metric_logger.meters['acc5'].update(acc5_s, n=batch_size)
-        metric_logger.meters['img/s'].update(batch_size / (time.time() - start_time))
+        metric_logger.update_on_device(acc1=acc1, acc5=acc5, n=batch_size)
+        metric_logger.count_samples(batch_size)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     return metric_logger.loss.global_avg, metric_logger.acc1.global_avg, metric_logger.acc5.global_avg
 
 
-def evaluate(model, criterion, data_loader, device, print_freq=100, header='Test:'):
+def evaluate(model, criterion, data_loader, device, print_freq=100, header='Test:', tile_size=None):
+    # the shards can have different numbers of batches, so the forward must not run the collectives of DDP
+    model = getattr(model, 'module', model)
     model.eval()
+    # imported here, so the scripts that import this file do not load pandas
+    import pandas as pd
     metric_logger = utils.MetricLogger(delimiter="  ")
+    for name in ['loss', 'acc1', 'acc5']:
+        metric_logger.add_meter(name, utils.SmoothedValue())
     all_idx = 0
     save_path = './firing'
     with torch.no_grad():
-        for image, target in metric_logger.log_every(data_loader, print_freq, header):
-            image = image.to(device, non_blocking=True)
-            target = target.to(device, non_blocking=True)
-            image = image.float()
-            output, firing_num = model(image)
+        for image, target in metric_logger.log_every(prefetch(data_loader, device), print_freq, header):
+            if tile_size:
+                output, firing_num = smodels.tiled_forward(model, image, tile_size)
+            else:
+                output, firing_num = model(image)
 
             lists = []
             for firing_single in firing_num:
                 sub_list = []
                 firing_single = firing_single.cpu().detach().numpy()
-                for T_ in range(args.T):
+                for T_ in range(firing_single.shape[0]):
                     sub_list.append(np.sum(firing_single[T_, :, :, :, :]))
                 sub_list.append(firing_single[0, :, :, :, :].shape[0] * firing_single[0, :, :, :, :].shape[1] *
                                 firing_single[0, :, :, :, :].shape[2] * firing_single[0, :, :, :, :].shape[3])
@@ -121,10 +133,9 @@ def evaluate(model, criterion, data_loader, device, print_freq=100, header='Test
             functional.reset_net(model)
 
             acc1, acc5 = utils.accuracy(output, target, topk=(1, 5))
-            batch_size = image.shape[0]
-            metric_logger.update(loss=loss.item())
-            metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-            metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
+            batch_size = target.shape[0]
+            # weighted by the batch size, so the averages over the shards without padding are exact
+            metric_logger.update_on_device(loss=loss, acc1=acc1, acc5=acc5, n=batch_size)
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
 
@@ -133,30 +144,100 @@ def evaluate(model, criterion, data_loader, device, print_freq=100, header='Test
     return loss, acc1, acc5
 
 
-def load_data(dataset_dir, distributed, T):
+def load_frame_store(dataset_dir, store_dir, train, T, store_T):
+    if not frame_store.is_packed(store_dir):
+        print(f'Packing frames to {store_dir}')
+        frame_store.pack_frames(
+            dvs128_gesture.DVS128Gesture(root=dataset_dir, train=train, data_type='frame', frames_number=store_T,
+                                         split_by='number'), store_dir)
+    return frame_store.FrameStore(store_dir, T)
+
+
+def load_event_store(dataset_dir, store_dir, train, T, augment=False, sparse=False, duration=None):
+    H, W = dvs128_gesture.DVS128Gesture.get_H_W()
+    if not event_store.is_packed(store_dir):
+        print(f'Packing events to {store_dir}')
+        aedat_dir = os.path.join(dataset_dir, 'extract', 'DvsGesture')
+        if os.path.exists(aedat_dir):
+            # stream the samples from the raw recordings rather than converting them to .npz files first
+            event_store.pack_event_samples(aedat.iter_dvs128_gesture(aedat_dir, train), store_dir, H, W)
+        else:
+            event_store.pack_events(dvs128_gesture.DVS128Gesture(root=dataset_dir, train=train, data_type='event'),
+                                    store_dir, H, W)
+    event_transform = None
+    if augment:
+        # the left and right hand gestures are mirror images of each other, so the events are not flipped. Frames
+        # split by the number of events do not depend on the timestamps, so they are only scaled with duration
+        time_scale = (0.8, 1.25) if duration else None
+        event_transform = event_augment.EventAugment(H, W, max_shift=16, drop_p=0.1, time_scale=time_scale)
+        print(event_transform)
+    return event_store.EventStore(store_dir, T, event_transform=event_transform, sparse=sparse, duration=duration)
+
+
+def load_data(dataset_dir, distributed, T, store_dir=None, T_train=None, event_store_dir=None, store_T=None,
+              augment=False, sparse=False, duration=None, test_only=False):
+    '''
+    Load the train and test splits and their samplers. If ``test_only``, the train split is not loaded, and
+    ``dataset_train`` and ``train_sampler`` are None.
+    '''
     # Data loading code
     print("Loading data")
 
     st = time.time()
 
-    dataset_train = dvs128_gesture.DVS128Gesture(root=dataset_dir, train=True, data_type='frame', frames_number=T,
-                                                 split_by='number')
-    dataset_test = dvs128_gesture.DVS128Gesture(root=dataset_dir, train=False, data_type='frame', frames_number=T,
-                                                split_by='number')
+    dataset_train = None
+    if event_store_dir:
+        if not test_only:
+            dataset_train = load_event_store(dataset_dir, os.path.join(event_store_dir, 'train'), True, T, augment,
+                                             sparse, duration)
+        dataset_test = load_event_store(dataset_dir, os.path.join(event_store_dir, 'test'), False, T, sparse=sparse,
+                                        duration=duration)
+    elif store_dir:
+        # coarser T are derived from a store packed with more frames
+        if store_T is None:
+            store_T = T
+        store_dir = os.path.join(store_dir, f'T{store_T}')
+        if not test_only:
+            dataset_train = load_frame_store(dataset_dir, os.path.join(store_dir, 'train'), True, T, store_T)
+        dataset_test = load_frame_store(dataset_dir, os.path.join(store_dir, 'test'), False, T, store_T)
+    else:
+        if not test_only:
+            dataset_train = dvs128_gesture.DVS128Gesture(root=dataset_dir, train=True, data_type='frame',
+                                                         frames_number=T, split_by='number')
+        dataset_test = dvs128_gesture.DVS128Gesture(root=dataset_dir, train=False, data_type='frame', frames_number=T,
+                                                    split_by='number')
+
+    if T_train and not duration and dataset_train is not None:
+        # subsampling frames would break the time grid of the frames with fixed duration
+        dataset_train = frame_store.RandomTemporalSubset(dataset_train, T_train)
 
     print("Took", time.time() - st)
 
     print("Creating data loaders")
+    train_sampler = None
     if distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(dataset_train)
-        test_sampler = torch.utils.data.distributed.DistributedSampler(dataset_test)
+        if dataset_train is not None:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(dataset_train)
+        # no padding, so every test sample is evaluated exactly once
+        test_sampler = utils.ShardedSampler(dataset_test)
     else:
-        train_sampler = torch.utils.data.RandomSampler(dataset_train)
+        if dataset_train is not None:
+            train_sampler = torch.utils.data.RandomSampler(dataset_train)
         test_sampler = torch.utils.data.SequentialSampler(dataset_test)
 
     return dataset_train, dataset_test, train_sampler, test_sampler
 
 
+def load_state_dict_by_order(model, state_dict):
+    # the checkpoints of smodels and smodels_firing_num have other names of the same parameters, which are matched by
+    # the order
+    keys1 = list(state_dict.keys())
+    keys2 = list(model.state_dict().keys())
+    for idx in range(len(keys1)):
+        state_dict[keys2[idx]] = state_dict.pop(keys1[idx])
+    model.load_state_dict(state_dict)
+
+
 def get_parameter_number(net):
     total_num = sum(p.numel() for p in net.parameters())
     trainable_num = sum(p.numel() for p in net.parameters() if p.requires_grad)
@@ -191,6 +272,9 @@ def main(args):
     if args.connect_f:
         output_dir += f'_cnf_{args.connect_f}'
 
+    if args.global_pool:
+        output_dir += '_gpool'
+
     if not os.path.exists(output_dir):
         utils.mkdir(output_dir)
 
@@ -198,7 +282,7 @@ def main(args):
     if not os.path.exists(output_dir):
         utils.mkdir(output_dir)
 
-    model = smodels_firing_num.__dict__[args.model](args.connect_f)
+    model = smodels_firing_num.__dict__[args.model](args.connect_f, global_pool=args.global_pool)
     print("Creating model")
     print(get_parameter_number(model))
     print(model)
@@ -207,23 +291,45 @@ def main(args):
 
     data_path = args.data_path
 
-    dataset_train, dataset_test, train_sampler, test_sampler = load_data(data_path, args.distributed, args.T)
-    print(f'dataset_train:{dataset_train.__len__()}, dataset_test:{dataset_test.__len__()}')
+    dataset_train, dataset_test, train_sampler, test_sampler = load_data(data_path, args.distributed, args.T,
+                                                                         args.frame_store, args.T_train,
+                                                                         args.event_store, args.frame_store_T,
+                                                                         args.event_augment, args.sparse_input,
+                                                                         args.duration, args.test_only)
+    if dataset_train is not None:
+        print(f'dataset_train:{dataset_train.__len__()}')
+    print(f'dataset_test:{dataset_test.__len__()}')
+
+    collate_fn = None
+    if args.duration:
+        collate_fn = frame_pack.padded_collate_fn
+    elif args.sparse_input:
+        collate_fn = event_store.sparse_collate_fn
+    elif args.pack_frames:
+        collate_fn = frame_pack.packed_collate_fn
+
+    data_loader_test = torch.utils.data.DataLoader(
+        dataset_test, batch_size=args.eval_batch_size or args.batch_size,
+        sampler=test_sampler, num_workers=args.workers, pin_memory=not args.sparse_input, collate_fn=collate_fn)
+
+    criterion = nn.CrossEntropyLoss()
+    if args.test_only:
+        # only the weights are loaded, and the optimizer and the train data are not created
+        if args.resume:
+            checkpoint = torch.load(args.resume, map_location='cpu', weights_only=False)
+            load_state_dict_by_order(model, checkpoint['model'] if 'model' in checkpoint else checkpoint)
+        model.to(device)
+        evaluate(model, criterion, data_loader_test, device=device, header='Test:', tile_size=args.tile_size)
+        return
 
     data_loader = torch.utils.data.DataLoader(
         dataset_train, batch_size=args.batch_size,
-        sampler=train_sampler, num_workers=args.workers, pin_memory=True)
-
-    data_loader_test = torch.utils.data.DataLoader(
-        dataset_test, batch_size=args.batch_size,
-        sampler=test_sampler, num_workers=args.workers, pin_memory=True)
+        sampler=train_sampler, num_workers=args.workers, pin_memory=not args.sparse_input, collate_fn=collate_fn)
 
     model.to(device)
     if args.distributed and args.sync_bn:
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
-    criterion = nn.CrossEntropyLoss()
-
     if args.adam:
         optimizer = torch.optim.Adam(
             model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
@@ -240,26 +346,24 @@ def main(args):
 
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        # DDP on cpu with gloo takes no device_ids
+        device_ids = [args.gpu] if device.type == 'cuda' else None
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
         model_without_ddp = model.module
 
     if args.resume:
-        checkpoint = torch.load(args.resume, map_location='cpu')
-        state_dict = checkpoint['model']
-        keys1 = list(state_dict.keys())
-        keys2 = list(model_without_ddp.state_dict().keys())
-        for idx in range(len(keys1)):
-            state_dict[keys2[idx]] = state_dict.pop(keys1[idx])
-        model_without_ddp.load_state_dict(state_dict)
+        checkpoint = torch.load(args.resume, map_location='cpu', weights_only=False)
+        load_state_dict_by_order(model_without_ddp, checkpoint['model'])
         optimizer.load_state_dict(checkpoint['optimizer'])
         lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
         args.start_epoch = checkpoint['epoch'] + 1
         max_test_acc1 = checkpoint['max_test_acc1']
         test_acc5_at_max_test_acc1 = checkpoint['test_acc5_at_max_test_acc1']
 
-    evaluate(model, criterion, data_loader_test, device=device, header='Test:')
+    evaluate(model, criterion, data_loader_test, device=device, header='Test:', tile_size=args.tile_size)
 
     # if args.tb and utils.is_main_process():
+    #     from torch.utils.tensorboard import SummaryWriter
     #     purge_step_train = args.start_epoch
     #     purge_step_te = args.start_epoch
     #     train_tb_writer = SummaryWriter(output_dir + '_logs/train', purge_step=purge_step_train)
@@ -276,7 +380,7 @@ def main(args):
     #     if args.distributed:
     #         train_sampler.set_epoch(epoch)
     #     train_loss, train_acc1, train_acc5 = train_one_epoch(model, criterion, optimizer, data_loader, device, epoch,
-    #                                                          args.print_freq, scaler, args.T_train)
+    #                                                          args.print_freq, scaler)
     #     if utils.is_main_process():
     #         train_tb_writer.add_scalar('train_loss', train_loss, epoch)
     #         train_tb_writer.add_scalar('train_acc1', train_acc1, epoch)
@@ -331,8 +435,30 @@ def parse_args():
     parser.add_argument('--model', default='SEWResNet', help='model')
 
     parser.add_argument('--data-path', default='D:/1/dataset/DVS128Gesture', help='dataset')
+    parser.add_argument('--frame-store', default=None,
+                        help='directory of the memory-mapped frame store, which is packed from --data-path on first use')
+    parser.add_argument('--frame-store-T', default=None, type=int,
+                        help='number of frames that the frame store is packed with, e.g., 240. Any --T that divides '
+                             'it is derived by summing contiguous frames. The default is --T')
+    parser.add_argument('--event-store', default=None,
+                        help='directory of the memory-mapped event store, which is packed from --data-path on first use. '
+                             'Frames are integrated for any --T when loading, and --frame-store is ignored')
+    parser.add_argument('--event-augment', action='store_true',
+                        help='augment the training events before integration. It requires --event-store')
+    parser.add_argument('--sparse-input', action='store_true',
+                        help='feed the frames as sparse tensors, and the first layer runs as a sparse-dense product '
+                             'without materializing the dense frames. It requires --event-store')
+    parser.add_argument('--pack-frames', action='store_true',
+                        help='send the frames from the data loading workers to the device as bitmasks and uint8 counts, '
+                             'which are unpacked on the device. Counts larger than 255 are saturated')
+    parser.add_argument('--duration', default=None, type=int,
+                        help='integrate the events into frames of this duration in microseconds, e.g., 300000, rather '
+                             'than into --T frames. The number of frames varies with the sample, and the padded steps '
+                             'are ignored by the model. It requires --event-store, and --T_train is ignored')
     parser.add_argument('--device', default='cpu', help='device')
     parser.add_argument('-b', '--batch-size', default=1, type=int)
+    parser.add_argument('--eval-batch-size', default=None, type=int,
+                        help='batch size of the evaluation (default: --batch-size)')
     parser.add_argument('--epochs', default=90, type=int, metavar='N',
                         help='number of total epochs to run')
     parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
@@ -381,6 +507,11 @@ def parse_args():
                         help='Use Adam')
 
     parser.add_argument('--connect_f', default='ADD', type=str, help='element-wise connect function')
+    parser.add_argument('--global-pool', action='store_true',
+                        help='average the spikes over the space before the classifier, so the model takes any resolution')
+    parser.add_argument('--tile-size', default=None, type=int,
+                        help='evaluate on overlapping tiles of this size with smodels.tiled_forward, for frames larger '
+                             'than the model takes, e.g., 346x260. Tiles other than 128 need --global-pool')
     parser.add_argument('--T_train', default=12, type=int)
 
     args = parser.parse_args()
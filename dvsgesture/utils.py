@@ -1,11 +1,20 @@
 from collections import defaultdict, deque
+import copy
 import datetime
 import time
+import numpy as np
 import torch
 import torch.distributed as dist
 
 import errno
+import glob
+import math
 import os
+import queue
+import random
+import re
+import shutil
+import threading
 
 
 class SmoothedValue(object):
@@ -26,18 +35,42 @@ class SmoothedValue(object):
         self.count += n
         self.total += value * n
 
-    def synchronize_between_processes(self):
+    def update_many(self, values, n=1):
+        """
+        Update with the values of many steps that are read back at once, e.g., by MetricLogger.flush.
+        ``n`` is the weight of every value or a list of the weights.
+        """
+        if isinstance(n, int):
+            n = [n] * len(values)
+        for value, n_ in zip(values, n):
+            self.update(value, n_)
+
+    def pack(self):
+        """
+        Return ``[count, total, values of the window]`` as a float64 tensor, whose window is padded with NaN to
+        ``window_size``, so the packed meters of all processes have the same length.
         """
-        Warning: does not synchronize the deque!
+        t = torch.full([2 + self.deque.maxlen], math.nan, dtype=torch.float64)
+        t[0] = self.count
+        t[1] = self.total
+        t[2: 2 + len(self.deque)] = torch.tensor(list(self.deque), dtype=torch.float64)
+        return t
+
+    def unpack(self, gathered):
         """
+        Merge the lists of :meth:`pack` of all processes. The count and total are summed, and the window holds the
+        windows of all processes, so median, avg and max are over all processes.
+        """
+        self.count = int(sum(g[0] for g in gathered))
+        self.total = sum(g[1] for g in gathered)
+        self.deque = deque([v for g in gathered for v in g[2:] if not math.isnan(v)],
+                           maxlen=(len(gathered[0]) - 2) * len(gathered))
+
+    def synchronize_between_processes(self):
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
-        dist.barrier()
-        dist.all_reduce(t)
-        t = t.tolist()
-        self.count = int(t[0])
-        self.total = t[1]
+        gathered = all_gather_flat(self.pack())
+        self.unpack([g.tolist() for g in gathered.cpu()])
 
     @property
     def median(self):
@@ -74,6 +107,13 @@ class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        # (name, 0-dim tensor, n, check_nan) of the values that are not read back from the device
+        self.pending = []
+        # name -> a bool tensor on the device, which is True if a value of name since the last check is not finite
+        self.nan_flags = {}
+        # the number of samples since log_every last updated the throughput meter, see count_samples
+        self.samples = 0
+        self.throughput_name = None
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
@@ -82,6 +122,62 @@ class MetricLogger(object):
             assert isinstance(v, (float, int))
             self.meters[k].update(v)
 
+    def update_on_device(self, n=1, check_nan=False, **kwargs):
+        """
+        Like update, but the tensors stay on their device, so it does not synchronize with the device. They are read
+        back together by flush, which log_every calls every ``print_freq`` steps and at the end. If ``check_nan``,
+        flush and check_nan raise ValueError when any of these values is NaN or infinite.
+        """
+        for k, v in kwargs.items():
+            if isinstance(v, torch.Tensor):
+                v = v.detach().reshape([]).to(torch.float32)
+                self.pending.append((k, v, n, check_nan))
+                if check_nan:
+                    flag = ~torch.isfinite(v)
+                    self.nan_flags[k] = flag if k not in self.nan_flags else self.nan_flags[k] | flag
+            else:
+                self.meters[k].update(v, n)
+
+    def check_nan(self):
+        """
+        Read back the flags of the values updated with ``check_nan=True`` since the last check with a single copy,
+        and raise ValueError if any of them is NaN or infinite. It is cheaper than flush, so it can run before every
+        checkpoint, which then never holds the weights of the steps after a NaN loss.
+        """
+        if len(self.nan_flags) == 0:
+            return
+        nan_flags, self.nan_flags = self.nan_flags, {}
+        for k, flag in zip(nan_flags.keys(), torch.stack(list(nan_flags.values())).tolist()):
+            if flag:
+                raise ValueError('{} is not finite'.format(k))
+
+    def count_samples(self, n, name='img/s'):
+        """
+        Count ``n`` samples for the throughput meter ``name``. Every ``print_freq`` steps, log_every updates it with
+        the samples per second since its last update, measured after flush has waited for the device.
+        """
+        self.samples += n
+        self.throughput_name = name
+
+    def flush(self):
+        """
+        Read back all pending values with a single copy and update the meters with them.
+        """
+        if len(self.pending) == 0:
+            return
+        pending, self.pending = self.pending, []
+        # all pending values are checked below
+        self.nan_flags = {}
+        values = torch.stack([v for _, v, _, _ in pending]).tolist()
+        batched = defaultdict(lambda: ([], []))
+        for (k, _, n, check_nan), value in zip(pending, values):
+            if check_nan and not math.isfinite(value):
+                raise ValueError('{} is not finite'.format(k))
+            batched[k][0].append(value)
+            batched[k][1].append(n)
+        for k, (values, n) in batched.items():
+            self.meters[k].update_many(values, n)
+
     def __getattr__(self, attr):
         if attr in self.meters:
             return self.meters[attr]
@@ -99,8 +195,21 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
-        for meter in self.meters.values():
-            meter.synchronize_between_processes()
+        """
+        Pack all meters into one buffer and gather it from all processes with a single collective. Every process must
+        have the same meters with the same window sizes, so register them by add_meter before the loop: a process whose
+        shard has no batches never updates them.
+        """
+        self.flush()
+        if not is_dist_avail_and_initialized():
+            return
+        names = sorted(self.meters.keys())
+        packed = [self.meters[name].pack() for name in names]
+        gathered = all_gather_flat(torch.cat(packed)).cpu().tolist()
+        start = 0
+        for name, t in zip(names, packed):
+            self.meters[name].unpack([g[start: start + t.numel()] for g in gathered])
+            start += t.numel()
 
     def add_meter(self, name, meter):
         self.meters[name] = meter
@@ -134,11 +243,18 @@ class MetricLogger(object):
                 'data: {data}'
             ])
         MB = 1024.0 * 1024.0
+        samples_time = start_time
         for obj in iterable:
             data_time.update(time.time() - end)
             yield obj
             iter_time.update(time.time() - end)
             if i % print_freq == 0:
+                self.flush()
+                if self.samples > 0:
+                    # flush has waited for the device, so the time covers the computation of the counted samples
+                    now = time.time()
+                    self.meters[self.throughput_name].update(self.samples / (now - samples_time))
+                    self.samples, samples_time = 0, now
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
                 if torch.cuda.is_available():
@@ -154,11 +270,119 @@ class MetricLogger(object):
                         time=str(iter_time), data=str(data_time)))
             i += 1
             end = time.time()
+        self.flush()
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('{} Total time: {}'.format(header, total_time_str))
 
 
+def to_device(data, device):
+    '''
+    Move every tensor in ``data``, which can be a tensor or nested tuples, namedtuples and lists of tensors, to
+    ``device`` without blocking. A dense CPU tensor is pinned first if it is not, so the copy is asynchronous.
+    '''
+    if isinstance(data, torch.Tensor):
+        if device.type == 'cuda' and data.device.type == 'cpu' and not data.is_sparse and not data.is_pinned():
+            data = data.pin_memory()
+        return data.to(device, non_blocking=True)
+    if isinstance(data, tuple) and hasattr(data, '_fields'):
+        return type(data)(*[to_device(x, device) for x in data])
+    if isinstance(data, (tuple, list)):
+        return type(data)(to_device(x, device) for x in data)
+    return data
+
+
+def record_stream(data, stream):
+    # tell the caching allocator that the tensors made on the side stream are used on ``stream``
+    if isinstance(data, torch.Tensor):
+        if data.is_sparse:
+            record_stream((data._indices(), data._values()), stream)
+        elif data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, (tuple, list)):
+        for x in data:
+            record_stream(x, stream)
+
+
+class DevicePrefetcher(object):
+    '''
+    Wrap ``data_loader`` to yield batches that are already on ``device``. A background thread takes the batches from
+    ``data_loader`` and calls ``convert`` on them, which moves them to ``device`` and casts them to the dtype or layout
+    that the model takes, and at most ``depth`` converted batches wait in a queue. On CUDA, ``convert`` runs on a side
+    stream, and the current stream of the consumer only waits on an event of the copy, so the host never waits on the
+    copy. On CPU, the conversion still runs in the background thread, while the main thread computes the last batch.
+
+    :param data_loader: an iterable of batches with ``__len__``, e.g., ``torch.utils.data.DataLoader``
+    :param device: the device of the batches
+    :param convert: a function that takes a batch from ``data_loader`` and returns the batch on ``device``. The
+            default is :func:`to_device`
+    :type convert: callable
+    :param depth: the number of converted batches that can wait in the queue
+    :type depth: int
+    '''
+    def __init__(self, data_loader, device, convert=None, depth=2):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        if convert is None:
+            def convert(batch):
+                return to_device(batch, self.device)
+        self.convert = convert
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _produce(self, batches: queue.Queue, stream, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self.data_loader:
+                if stream is None:
+                    item = (self.convert(batch), None)
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = self.convert(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    item = (batch, event)
+                if not put(item):
+                    return
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stream, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    record_stream(batch, current_stream)
+                yield batch
+        finally:
+            # stop the thread if the consumer breaks early
+            stop.set()
+            thread.join()
+
+
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     with torch.no_grad():
@@ -223,21 +447,385 @@ def is_main_process():
     return get_rank() == 0
 
 
+def get_dist_device():
+    # the tensors of collectives must be on the gpu with nccl and on the cpu with gloo
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def all_gather_flat(t):
+    """
+    Gather the 1-D tensor ``t`` of the same length from all processes without a barrier.
+
+    :return: a tensor with ``shape = [world_size, t.numel()]`` on the cpu or gpu as the backend requires
+    """
+    t = t.to(get_dist_device())
+    gathered = torch.empty([get_world_size(), t.numel()], dtype=t.dtype, device=t.device)
+    dist.all_gather(list(gathered.unbind(0)), t)
+    return gathered
+
+
+class ShardedSampler(torch.utils.data.Sampler):
+    """
+    Split the indices of ``data_source`` into ``num_replicas`` disjoint contiguous shards without padding, whose sizes
+    differ by at most 1. Unlike ``DistributedSampler``, no sample is evaluated twice, so the metrics computed from all
+    shards, e.g., by :func:`gather_shards`, are exact at any world size.
+    """
+    def __init__(self, data_source, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = get_world_size()
+        if rank is None:
+            rank = get_rank()
+        n = len(data_source)
+        self.sizes = [(r + 1) * n // num_replicas - r * n // num_replicas for r in range(num_replicas)]
+        self.start = rank * n // num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.start, self.start + self.sizes[self.rank]))
+
+    def __len__(self):
+        return self.sizes[self.rank]
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    A sampler like ``DistributedSampler`` whose position in an epoch can be saved and restored. All processes draw
+    the same permutation of the epoch, and process ``rank`` takes every ``num_replicas``-th index of the unconsumed
+    part of it. After :meth:`load_state_dict`, the iteration starts from the first unconsumed index, so the consumed
+    samples are never loaded again. The shards are not padded, so no sample is duplicated, and the processes can
+    have one sample less than the others; wrap a DDP training loop in ``model.join()``.
+
+    :param data_source: the dataset
+    :param shuffle: draw a random permutation by ``seed + epoch`` for every epoch, or use the order of the dataset
+    :type shuffle: bool
+    :param seed: the seed of the permutations, which must be the same in all processes
+    :type seed: int
+    """
+    def __init__(self, data_source, shuffle=True, seed=0, num_replicas=None, rank=None):
+        self.num_samples = len(data_source)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+        self.epoch = 0
+        self.permutation = None
+        # the number of indices of the permutation that are consumed by all processes
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        # a restored epoch keeps its permutation and position
+        if epoch == self.epoch and self.permutation is not None:
+            return
+        self.epoch = epoch
+        self.permutation = None
+        self.start = 0
+
+    def _get_permutation(self):
+        if self.permutation is None:
+            if self.shuffle:
+                g = torch.Generator()
+                g.manual_seed(self.seed + self.epoch)
+                self.permutation = torch.randperm(self.num_samples, generator=g)
+            else:
+                self.permutation = torch.arange(self.num_samples)
+        return self.permutation
+
+    def __iter__(self):
+        return iter(self._get_permutation()[self.start + self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return len(range(self.start + self.rank, self.num_samples, self.num_replicas))
+
+    def state_dict(self, num_consumed=0):
+        """
+        :param num_consumed: the number of samples that each process has consumed in this iteration
+        :type num_consumed: int
+        """
+        return {
+            'epoch': self.epoch,
+            'seed': self.seed,
+            'permutation': self._get_permutation(),
+            'start': min(self.start + num_consumed * self.num_replicas, self.num_samples),
+        }
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.seed = state_dict['seed']
+        self.permutation = state_dict['permutation']
+        self.start = state_dict['start']
+
+
+def get_rng_state():
+    # the states of all random number generators of this process
+    state = {
+        'random': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def gather_shards(t, sampler):
+    """
+    :param t: a tensor with ``shape = [len(sampler), C]`` computed from the samples of ``sampler``
+    :type t: torch.Tensor
+    :param sampler: the sampler of the data loader, which is :class:`ShardedSampler` in distributed mode
+    :return: a cpu tensor with ``shape = [len(dataset), C]`` in the order of the dataset
+
+    Gather the rows of all shards with one collective. The shards are padded to the same length for the collective
+    and the padding is removed by the known shard sizes, so every sample is counted exactly once.
+    """
+    if not isinstance(sampler, ShardedSampler) or not is_dist_avail_and_initialized():
+        return t.cpu()
+    max_size = max(sampler.sizes)
+    padded = torch.zeros([max_size, t.shape[1]], dtype=t.dtype, device=t.device)
+    padded[0: t.shape[0]] = t
+    gathered = all_gather_flat(padded.flatten()).view(len(sampler.sizes), max_size, t.shape[1]).cpu()
+    return torch.cat([gathered[r, 0: size] for r, size in enumerate(sampler.sizes)])
+
+
+def snapshot_to_cpu(obj):
+    """
+    Copy every tensor in ``obj``, e.g., a checkpoint of state dicts, to the cpu and copy the other objects, so the
+    training can go on while the snapshot is serialized.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # the versions of the modules in a state dict of nn.Module
+            snapshot._metadata = copy.deepcopy(obj._metadata)
+        return snapshot
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def link_or_copy(src, dst):
+    # replace dst by a hard link of src atomically, or by a copy if the file system has no hard links
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CheckpointWriter(object):
+    """
+    Save the checkpoints of the main process in a background thread. :meth:`save` only copies the state to the host
+    memory, and the thread serializes it once to a temporary file and renames it to the first name, so a file with
+    the name of a checkpoint is always complete. The other names of the same checkpoint, e.g., the latest and the best
+    checkpoint of an epoch, are hard links of the first file. At most one snapshot waits while another one is written.
+
+    :param output_dir: the directory of the checkpoints
+    :type output_dir: str
+    :param max_kept: the number of the newest ``checkpoint_{epoch}.pth`` to keep, or keep all if None. The other
+            names, e.g., ``checkpoint_latest.pth``, are not affected
+    :type max_kept: int
+    """
+    def __init__(self, output_dir, max_kept=None):
+        self.output_dir = output_dir
+        self.max_kept = max_kept
+        self.jobs = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = None
+        if is_main_process():
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                checkpoint, paths, callback = job
+                self._write(checkpoint, paths)
+                if callback is not None:
+                    callback(paths)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _write(self, checkpoint, paths):
+        tmp = paths[0] + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        for path in paths[1:]:
+            link_or_copy(tmp, path)
+        os.replace(tmp, paths[0])
+        if self.max_kept is not None:
+            self._remove_old()
+
+    def _remove_old(self):
+        epochs = []
+        for name in os.listdir(self.output_dir):
+            matched = re.fullmatch(r'checkpoint_(\d+)\.pth', name)
+            if matched:
+                epochs.append(int(matched.group(1)))
+        for epoch in sorted(epochs)[0: max(len(epochs) - self.max_kept, 0)]:
+            os.remove(os.path.join(self.output_dir, f'checkpoint_{epoch}.pth'))
+
+    def save(self, checkpoint, names, callback=None):
+        """
+        :param checkpoint: the object to save, whose tensors can be on any device
+        :param names: the file names of ``checkpoint`` in ``output_dir``
+        :type names: list
+        :param callback: a function called by the background thread with the paths of ``names`` after they are written
+        :type callback: callable
+
+        Return after ``checkpoint`` is copied to the host memory. It blocks if the last two snapshots are not written
+        yet, and raises the error of a former failed write. It does nothing if this is not the main process.
+        """
+        if self.thread is None:
+            return
+        self._check_error()
+        paths = [os.path.join(self.output_dir, name) for name in names]
+        self.jobs.put((snapshot_to_cpu(checkpoint), paths, callback))
+
+    def wait(self):
+        # wait until all snapshots are written
+        if self.thread is None:
+            return
+        self.jobs.join()
+        self._check_error()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.jobs.put(None)
+        self.thread.join()
+        self.thread = None
+        self._check_error()
+
+
 def save_on_master(*args, **kwargs):
     if is_main_process():
         torch.save(*args, **kwargs)
 
 
+def parse_cpulist(cpulist: str):
+    # e.g., '0-3,8-11' -> [0, 1, 2, 3, 8, 9, 10, 11]
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def get_numa_cpus(reserved_cpus=()):
+    """
+    Return the lists of the cpus that this process can run on, except ``reserved_cpus``, one list for each NUMA node.
+    All cpus are in one list if the NUMA topology is unknown, e.g., not on Linux.
+    """
+    if not hasattr(os, 'sched_getaffinity'):
+        return [[cpu for cpu in range(os.cpu_count()) if cpu not in reserved_cpus]]
+    allowed = os.sched_getaffinity(0) - set(reserved_cpus)
+    nodes = []
+    node_files = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    for node_file in sorted(node_files, key=lambda f: int(os.path.basename(os.path.dirname(f))[4:])):
+        with open(node_file) as f:
+            cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in allowed]
+        if len(cpus) > 0:
+            nodes.append(cpus)
+    if len(nodes) == 0:
+        nodes.append(sorted(allowed))
+    return nodes
+
+
+def get_slurm_local_world_size():
+    """
+    Return the number of the tasks of a SLURM job on this node, or None if it is unknown. ``SLURM_NTASKS_PER_NODE``
+    is only set with ``--ntasks-per-node``, while ``SLURM_TASKS_PER_NODE``, e.g., ``'4(x2),3'``, is always set.
+    """
+    if 'SLURM_NTASKS_PER_NODE' in os.environ:
+        return int(os.environ['SLURM_NTASKS_PER_NODE'])
+    if 'SLURM_TASKS_PER_NODE' in os.environ:
+        tasks = []
+        for part in os.environ['SLURM_TASKS_PER_NODE'].split(','):
+            match = re.fullmatch(r'(\d+)(?:\(x(\d+)\))?', part.strip())
+            if match is not None:
+                tasks.extend([int(match.group(1))] * int(match.group(2) or 1))
+        node_id = int(os.environ.get('SLURM_NODEID', 0))
+        if node_id < len(tasks):
+            return tasks[node_id]
+    if 'SLURM_NTASKS' in os.environ:
+        return math.ceil(int(os.environ['SLURM_NTASKS']) / int(os.environ.get('SLURM_NNODES', 1)))
+    return None
+
+
+def pin_cpu_threads(local_rank, local_world_size, reserved_cpus=()):
+    """
+    Pin this process to its share of the cpus of this machine and use one intra-op thread for every cpu. The ranks are
+    placed on the NUMA nodes in contiguous blocks, and the cpus of a node are split evenly among the ranks on it, so
+    the memory of a rank is allocated on its own node. If there are fewer ranks than nodes, a rank takes whole nodes.
+    ``reserved_cpus`` are left to other processes, e.g., an evaluation process. Return the pinned cpus, or None if the
+    ranks of this machine are unknown, in which case the affinity is left alone.
+    """
+    if local_world_size is None or not 0 <= local_rank < local_world_size:
+        return None
+    nodes = get_numa_cpus(reserved_cpus)
+    n = len(nodes)
+    if local_world_size <= n:
+        cpus = sum(nodes[local_rank * n // local_world_size: (local_rank + 1) * n // local_world_size], [])
+    else:
+        node = local_rank * n // local_world_size
+        ranks = [r for r in range(local_world_size) if r * n // local_world_size == node]
+        i = ranks.index(local_rank)
+        cpus = nodes[node][i * len(nodes[node]) // len(ranks): (i + 1) * len(nodes[node]) // len(ranks)]
+        if len(cpus) == 0:
+            # more ranks than cpus on this node
+            cpus = nodes[node]
+    if len(cpus) == 0:
+        return None
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    # torchrun sets OMP_NUM_THREADS=1, which leaves all but one of the pinned cpus idle
+    torch.set_num_threads(len(cpus))
+    return cpus
+
+
 def init_distributed_mode(args):
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         args.rank = int(os.environ["RANK"])
         args.world_size = int(os.environ['WORLD_SIZE'])
         args.gpu = int(os.environ['LOCAL_RANK'])
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
     elif 'SLURM_PROCID' in os.environ:
         args.rank = int(os.environ['SLURM_PROCID'])
-        args.gpu = args.rank % torch.cuda.device_count()
+        local_world_size = get_slurm_local_world_size()
+        if torch.device(args.device).type == 'cuda':
+            args.gpu = args.rank % torch.cuda.device_count()
+        else:
+            args.gpu = int(os.environ.get('SLURM_LOCALID', 0))
     elif hasattr(args, "rank"):
-        pass
+        # the ranks on this machine are unknown, so they are not pinned
+        local_world_size = None
     else:
         print('Not using distributed mode')
         args.distributed = False
@@ -245,8 +833,18 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = 'nccl'
+    if torch.device(args.device).type == 'cuda':
+        torch.cuda.set_device(args.gpu)
+        args.dist_backend = 'nccl'
+    else:
+        # args.gpu is the local rank on cpu
+        args.dist_backend = 'gloo'
+        cpus = pin_cpu_threads(args.gpu, local_world_size, getattr(args, 'reserved_cpus', ()))
+        if cpus is None:
+            print('| rank {} is not pinned, local rank {} of {}'.format(args.rank, args.gpu, local_world_size),
+                  flush=True)
+        else:
+            print('| rank {} is pinned to {} cpus: {}'.format(args.rank, len(cpus), cpus), flush=True)
     print('| distributed init (rank {}): {}'.format(
         args.rank, args.dist_url), flush=True)
     torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import torchvision
+from torchvision.datasets.folder import default_loader
+
+__all__ = ['ImageFolder', 'pack_samples']
+
+
+def pack_samples(samples):
+    """Pack a list of ``(path, class_index)`` tuples into three flat arrays.
+
+    Returns ``(path_buffer, path_offsets, targets)``: ``path_buffer`` is a ``uint8`` array holding all encoded paths
+    back to back, the ``i``-th path is ``path_buffer[path_offsets[i]:path_offsets[i + 1]]``, and ``targets`` is an
+    ``int64`` array of class indices. The arrays hold no Python objects, so forked DataLoader workers never touch
+    their refcounts and the pages stay shared with the main process.
+    """
+    encoded = [os.fsencode(path) for path, _ in samples]
+    path_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in encoded], out=path_offsets[1:])
+    path_buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8).copy()
+    targets = np.asarray([target for _, target in samples], dtype=np.int64)
+    return path_buffer, path_offsets, targets
+
+
+class ImageFolder(torchvision.datasets.ImageFolder):
+    """Drop-in replacement for :class:`torchvision.datasets.ImageFolder` whose sample table is kept in NumPy arrays
+    (see :func:`pack_samples`) instead of a list of tuples, so worker memory stays flat as ``--workers`` grows.
+    """
+
+    def __init__(self, root, transform=None, target_transform=None, loader=default_loader, is_valid_file=None):
+        super(ImageFolder, self).__init__(root, transform=transform, target_transform=target_transform,
+                                          loader=loader, is_valid_file=is_valid_file)
+        self.path_buffer, self.path_offsets, self.targets = pack_samples(self.samples)
+        del self.samples, self.imgs
+
+    def get_path(self, index):
+        start, end = self.path_offsets[index], self.path_offsets[index + 1]
+        return os.fsdecode(self.path_buffer[start:end].tobytes())
+
+    def __getitem__(self, index):
+        path = self.get_path(index)
+        target = int(self.targets[index])
+        sample = self.loader(path)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __len__(self):
+        return self.targets.shape[0]
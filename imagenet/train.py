@@ -1,4 +1,6 @@
+import contextlib
 import datetime
+import glob
 import os
 import time
 import torch
@@ -6,14 +8,14 @@ import torch.utils.data
 from torch import nn
 import torchvision
 from torchvision import transforms
-from torch.utils.tensorboard import SummaryWriter
 import math
 from torch.cuda import amp
 import torch.distributed.optim
 import argparse
+import queue
 
 from spikingjelly.clock_driven import functional
-import spiking_resnet, sew_resnet, utils
+import spiking_resnet, sew_resnet, utils, folder
 
 _seed_ = 2020
 import random
@@ -31,52 +33,58 @@ import numpy as np
 np.random.seed(_seed_)
 
 
-def train_one_epoch(model, criterion, optimizer, data_loader, device, epoch, print_freq, scaler=None):
+def train_one_epoch(model, criterion, optimizer, data_loader, device, epoch, print_freq, scaler=None, save_step=None):
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value}'))
     metric_logger.add_meter('img/s', utils.SmoothedValue(window_size=10, fmt='{value}'))
+    # registered up front, so a process without batches still has them in synchronize_between_processes
+    for name in ['loss', 'acc1', 'acc5']:
+        metric_logger.add_meter(name, utils.SmoothedValue())
 
     header = 'Epoch: [{}]'.format(epoch)
 
-    for image, target in metric_logger.log_every(data_loader, print_freq, header):
-        start_time = time.time()
-        image, target = image.to(device), target.to(device)
-        # with torch.autograd.detect_anomaly():
-        if scaler is not None:
-            with amp.autocast():
+    steps = 0
+    # the shards of utils.ResumableSampler are not padded, so a process can have a batch less than the others, and
+    # join shadows the collectives of DDP for it
+    join = model.join() if isinstance(model, nn.parallel.DistributedDataParallel) else contextlib.nullcontext()
+    with join:
+        for image, target in metric_logger.log_every(utils.DevicePrefetcher(data_loader, device), print_freq, header):
+            # with torch.autograd.detect_anomaly():
+            if scaler is not None:
+                with amp.autocast():
+                    output = model(image)
+                    loss = criterion(output, target)
+            else:
                 output = model(image)
                 loss = criterion(output, target)
-        else:
-            output = model(image)
-            loss = criterion(output, target)
 
-        optimizer.zero_grad()
+            optimizer.zero_grad()
 
-        if scaler is not None:
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
+            if scaler is not None:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
-        else:
-            loss.backward()
-            optimizer.step()
+            else:
+                loss.backward()
+                optimizer.step()
 
-        functional.reset_net(model)
+            functional.reset_net(model)
 
-        acc1, acc5 = utils.accuracy(output, target, topk=(1, 5))
-        batch_size = image.shape[0]
-        loss_s = loss.item()
-        if math.isnan(loss_s):
-            raise ValueError('loss is Nan')
-        acc1_s = acc1.item()
-        acc5_s = acc5.item()
+            acc1, acc5 = utils.accuracy(output, target, topk=(1, 5))
+            batch_size = image.shape[0]
+            # the metrics stay on the device until log_every reads them back every print_freq steps
+            metric_logger.update_on_device(loss=loss, check_nan=True)
+            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
-        metric_logger.update(loss=loss_s, lr=optimizer.param_groups[0]["lr"])
+            metric_logger.update_on_device(acc1=acc1, acc5=acc5, n=batch_size)
+            metric_logger.count_samples(batch_size)
 
-        metric_logger.meters['acc1'].update(acc1_s, n=batch_size)
-        metric_logger.meters['acc5'].update(acc5_s, n=batch_size)
-        metric_logger.meters['img/s'].update(batch_size / (time.time() - start_time))
+            steps += 1
+            if save_step is not None:
+                # it may save a checkpoint to resume from the next step
+                save_step(epoch, steps, metric_logger)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -84,28 +92,45 @@ def train_one_epoch(model, criterion, optimizer, data_loader, device, epoch, pri
 
 
 
-def evaluate(model, criterion, data_loader, device, print_freq=100, header='Test:'):
+def evaluate(model, criterion, data_loader, device, print_freq=100, header='Test:', predictions_file=None):
+    '''
+    Evaluate ``model`` on the shards of ``data_loader``. The top-5 classes, the label and the loss of every sample are
+    gathered from all processes, and the returned metrics are computed from them, so they are exact at any world
+    size if the sampler is ``utils.ShardedSampler``. The main process saves the gathered predictions to
+    ``predictions_file`` if it is not None.
+    '''
+    # the shards can have different numbers of batches, so the forward must not run the collectives of DDP
+    model = getattr(model, 'module', model)
     model.eval()
     metric_logger = utils.MetricLogger(delimiter="  ")
+    predictions = []
     with torch.no_grad():
-        for image, target in metric_logger.log_every(data_loader, print_freq, header):
-            image = image.to(device, non_blocking=True)
-            target = target.to(device, non_blocking=True)
+        for image, target in metric_logger.log_every(utils.DevicePrefetcher(data_loader, device), print_freq, header):
             output = model(image)
             loss = criterion(output, target)
             functional.reset_net(model)
 
+            # [N, 7] = the top-5 classes, the label and the loss of every sample
+            sample_loss = nn.functional.cross_entropy(output, target, reduction='none')
+            predictions.append(torch.stack([*output.topk(5, 1)[1].t(), target, sample_loss], 1).double())
+
             acc1, acc5 = utils.accuracy(output, target, topk=(1, 5))
-            # FIXME need to take into account that the datasets
-            # could have been padded in distributed setup
             batch_size = image.shape[0]
-            metric_logger.update(loss=loss.item())
-            metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-            metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
-    # gather the stats from all processes
-    metric_logger.synchronize_between_processes()
-
-    loss, acc1, acc5 = metric_logger.loss.global_avg, metric_logger.acc1.global_avg, metric_logger.acc5.global_avg
+            metric_logger.update_on_device(loss=loss)
+            metric_logger.update_on_device(acc1=acc1, acc5=acc5, n=batch_size)
+
+    predictions = torch.cat(predictions) if len(predictions) > 0 else torch.zeros([0, 7], dtype=torch.float64)
+    predictions = utils.gather_shards(predictions, data_loader.sampler)
+    top5, target, losses = predictions[:, 0: 5].long(), predictions[:, 5].long(), predictions[:, 6]
+    correct = top5 == target.unsqueeze(1)
+    n = max(predictions.shape[0], 1)
+    loss = losses.sum().item() / n
+    acc1 = correct[:, 0].sum().item() * 100. / n
+    acc5 = correct.any(1).sum().item() * 100. / n
+    if predictions_file is not None and utils.is_main_process():
+        np.savez(predictions_file, top5=top5.short().numpy(), target=target.short().numpy(),
+                 loss=losses.float().numpy())
+        print(f'Save the predictions of {predictions.shape[0]} samples to {predictions_file}')
     print(f' * Acc@1 = {acc1}, Acc@5 = {acc5}, loss = {loss}')
     return loss, acc1, acc5
 
@@ -113,7 +138,7 @@ def evaluate(model, criterion, data_loader, device, print_freq=100, header='Test
 def _get_cache_path(filepath):
     import hashlib
     h = hashlib.sha1(filepath.encode()).hexdigest()
-    cache_path = os.path.join("~", ".torch", "vision", "datasets", "imagefolder", h[:10] + ".pt")
+    cache_path = os.path.join("~", ".torch", "vision", "datasets", "imagefolder", h[:10] + "_compact.pt")
     cache_path = os.path.expanduser(cache_path)
     return cache_path
 
@@ -131,7 +156,7 @@ def load_data(traindir, valdir, cache_dataset, distributed):
         print("Loading dataset_train from {}".format(cache_path))
         dataset, _ = torch.load(cache_path)
     else:
-        dataset = torchvision.datasets.ImageFolder(
+        dataset = folder.ImageFolder(
             traindir,
             transforms.Compose([
                 transforms.RandomResizedCrop(224),
@@ -145,6 +170,23 @@ def load_data(traindir, valdir, cache_dataset, distributed):
             utils.save_on_master((dataset, traindir), cache_path)
     print("Took", time.time() - st)
 
+    dataset_test = load_test_data(valdir, cache_dataset)
+
+    print("Creating data loaders")
+    # the position of the train sampler is saved in the checkpoints in the middle of an epoch
+    train_sampler = utils.ResumableSampler(dataset)
+    if distributed:
+        # no padding, so every test sample is evaluated exactly once
+        test_sampler = utils.ShardedSampler(dataset_test)
+    else:
+        test_sampler = torch.utils.data.SequentialSampler(dataset_test)
+
+    return dataset, dataset_test, train_sampler, test_sampler
+
+
+def load_test_data(valdir, cache_dataset):
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                     std=[0.229, 0.224, 0.225])
     print("Loading validation data")
     cache_path = _get_cache_path(valdir)
     if cache_dataset and os.path.exists(cache_path):
@@ -152,7 +194,7 @@ def load_data(traindir, valdir, cache_dataset, distributed):
         print("Loading dataset_test from {}".format(cache_path))
         dataset_test, _ = torch.load(cache_path)
     else:
-        dataset_test = torchvision.datasets.ImageFolder(
+        dataset_test = folder.ImageFolder(
             valdir,
             transforms.Compose([
                 transforms.Resize(256),
@@ -164,16 +206,154 @@ def load_data(traindir, valdir, cache_dataset, distributed):
             print("Saving dataset_test to {}".format(cache_path))
             utils.mkdir(os.path.dirname(cache_path))
             utils.save_on_master((dataset_test, valdir), cache_path)
+    return dataset_test
 
-    print("Creating data loaders")
-    if distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(dataset)
-        test_sampler = torch.utils.data.distributed.DistributedSampler(dataset_test)
+
+def create_model(args):
+    if args.model in sew_resnet.__dict__:
+        model = sew_resnet.__dict__[args.model](zero_init_residual=args.zero_init_residual, T=args.T, connect_f=args.connect_f)
+    elif args.model in spiking_resnet.__dict__:
+        model = spiking_resnet.__dict__[args.model](zero_init_residual=args.zero_init_residual, T=args.T)
+    else:
+        raise NotImplementedError(args.model)
+    return model
+
+
+def evaluate_checkpoints(args, jobs, results):
+    '''
+    The loop of the process of :class:`AsyncEvaluator`. It evaluates the checkpoints whose paths are put in ``jobs``
+    and puts ``(epoch, path, loss, acc1, acc5)`` in ``results``, until it gets None.
+    '''
+    # the process inherits the affinity of the pinned main process, so it is set to the cpus chosen before pinning
+    if args.async_eval_cpus is not None:
+        os.sched_setaffinity(0, args.async_eval_cpus)
+    if args.async_eval_threads > 0:
+        torch.set_num_threads(args.async_eval_threads)
+    device = torch.device(args.async_eval_device)
+    dataset_test = load_test_data(os.path.join(args.data_path, 'val'), args.cache_dataset)
+    data_loader_test = torch.utils.data.DataLoader(
+        dataset_test, batch_size=args.eval_batch_size or args.batch_size,
+        sampler=torch.utils.data.SequentialSampler(dataset_test), num_workers=args.workers, pin_memory=True)
+    model = create_model(args)
+    model.to(device)
+    criterion = nn.CrossEntropyLoss()
+    while True:
+        path = jobs.get()
+        if path is None:
+            break
+        checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+        model.load_state_dict(checkpoint['model'])
+        test_loss, test_acc1, test_acc5 = evaluate(model, criterion, data_loader_test, device=device,
+                                                   header=f'Async test: [{checkpoint["epoch"]}]')
+        results.put((checkpoint['epoch'], path, test_loss, test_acc1, test_acc5))
+    results.put(None)
+
+
+class AsyncEvaluator(object):
+    '''
+    Evaluate the checkpoints in another process with its own cpus or device, so the training does not wait for the
+    evaluation. Pass :meth:`submit` as the callback of ``utils.CheckpointWriter.save``, whose last name is the
+    checkpoint to evaluate, and get the metrics by :meth:`results`. At most one checkpoint waits while another is
+    evaluated: a newer one replaces it, and its file is removed, so the lag and the disk usage do not grow when the
+    evaluation is slower than an epoch.
+    '''
+    def __init__(self, args):
+        # spawn, because the training process can have cuda and threads
+        ctx = torch.multiprocessing.get_context('spawn')
+        self.jobs = ctx.Queue(maxsize=1)
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=evaluate_checkpoints, args=(args, self.jobs, self.result_queue), daemon=True)
+        self.process.start()
+
+    def submit(self, paths):
+        while True:
+            try:
+                self.jobs.put_nowait(paths[-1])
+                return
+            except queue.Full:
+                try:
+                    stale = self.jobs.get_nowait()
+                except queue.Empty:
+                    # the evaluation process has just taken it
+                    continue
+                print(f'Skip the evaluation of {stale}')
+                os.remove(stale)
+
+    def results(self, block=False):
+        '''
+        Yield the results that are ready, or all results until the process exits if ``block``.
+        '''
+        while True:
+            try:
+                result = self.result_queue.get(timeout=1.) if block else self.result_queue.get_nowait()
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                return
+            if result is None:
+                return
+            yield result
+
+    def close(self):
+        # the caller gets the remaining results by results(block=True)
+        self.jobs.put(None)
+
+
+def rescale_for_world_size(args, checkpoint):
+    '''
+    Set ``args.batch_size`` and ``args.lr_scale`` for the current world size by ``args.elastic_policy``, when the
+    training goes on from ``checkpoint`` saved at another world size. With ``linear``, the batch size of every process
+    is kept and the learning rate is scaled linearly with the global batch size. With ``global``, the global batch size
+    and the learning rate are kept, and the batch size of every process is divided by the world size.
+    '''
+    args.lr_scale = 1.
+    world_size = utils.get_world_size()
+    if 'world_size' not in checkpoint or args.elastic_policy == 'none':
+        return
+    old_batch_size, old_world_size = checkpoint['batch_size'], checkpoint['world_size']
+    if args.elastic_policy == 'global':
+        args.batch_size = max(old_batch_size * old_world_size // world_size, 1)
+    else:
+        args.batch_size = old_batch_size
+    # the global batch size of 'global' can differ a little by the rounding
+    args.lr_scale = args.batch_size * world_size / (old_batch_size * old_world_size)
+    print(f'world size: {old_world_size} -> {world_size}, batch size: {old_batch_size} -> {args.batch_size}, '
+          f'lr scale: {args.lr_scale}')
+
+
+def scale_lr(optimizer, lr_scheduler, scale):
+    # scale the current and the base learning rates, so the schedule goes on at the new scale
+    if scale == 1.:
+        return
+    for group in optimizer.param_groups:
+        group['lr'] *= scale
+        if 'initial_lr' in group:
+            group['initial_lr'] *= scale
+    lr_scheduler.base_lrs = [lr * scale for lr in lr_scheduler.base_lrs]
+    lr_scheduler._last_lr = [group['lr'] for group in optimizer.param_groups]
+
+
+def test(args, checkpoint, output_dir):
+    '''
+    The entry of ``--test-only``. Only the validation data and the model are created, and the weights are loaded
+    from ``checkpoint`` directly, which can be a full checkpoint or a state dict.
+    '''
+    device = torch.device(args.device)
+    dataset_test = load_test_data(os.path.join(args.data_path, 'val'), args.cache_dataset)
+    if args.distributed:
+        test_sampler = utils.ShardedSampler(dataset_test)
     else:
-        train_sampler = torch.utils.data.RandomSampler(dataset)
         test_sampler = torch.utils.data.SequentialSampler(dataset_test)
+    data_loader_test = torch.utils.data.DataLoader(
+        dataset_test, batch_size=args.eval_batch_size or args.batch_size,
+        sampler=test_sampler, num_workers=args.workers, pin_memory=True)
 
-    return dataset, dataset_test, train_sampler, test_sampler
+    model = create_model(args)
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'] if 'model' in checkpoint else checkpoint)
+    model.to(device)
+    evaluate(model, nn.CrossEntropyLoss(), data_loader_test, device=device, header='Test:',
+             predictions_file=os.path.join(output_dir, 'predictions_test.npz'))
 
 
 def main(args):
@@ -186,6 +366,14 @@ def main(args):
     train_tb_writer = None
     te_tb_writer = None
 
+    # the cpus of the --async-eval process. With --async-eval-threads N, the last N cpus are reserved for it, and the
+    # training processes on cpu are pinned to the others
+    args.async_eval_cpus = None
+    args.reserved_cpus = []
+    if args.async_eval and hasattr(os, 'sched_getaffinity'):
+        args.async_eval_cpus = sorted(os.sched_getaffinity(0))
+        if args.async_eval_threads > 0:
+            args.async_eval_cpus = args.reserved_cpus = args.async_eval_cpus[-args.async_eval_threads:]
 
     utils.init_distributed_mode(args)
     print(args)
@@ -209,6 +397,21 @@ def main(args):
     if output_dir:
         utils.mkdir(output_dir)
 
+    if args.elastic and not args.resume and os.path.exists(os.path.join(output_dir, 'checkpoint_latest.pth')):
+        # restarted by torchrun after a rank is lost or the number of nodes changes
+        args.resume = os.path.join(output_dir, 'checkpoint_latest.pth')
+        print(f'Resume from {args.resume}')
+
+    checkpoint = None
+    if args.resume:
+        # the checkpoint holds args and rng states, which are not weights
+        checkpoint = torch.load(args.resume, map_location='cpu', weights_only=False)
+        if args.elastic:
+            rescale_for_world_size(args, checkpoint)
+
+    if args.test_only:
+        test(args, checkpoint, output_dir)
+        return
 
     device = torch.device(args.device)
 
@@ -223,17 +426,11 @@ def main(args):
         sampler=train_sampler, num_workers=args.workers, pin_memory=True)
 
     data_loader_test = torch.utils.data.DataLoader(
-        dataset_test, batch_size=args.batch_size,
+        dataset_test, batch_size=args.eval_batch_size or args.batch_size,
         sampler=test_sampler, num_workers=args.workers, pin_memory=True)
 
     print("Creating model")
-
-    if args.model in sew_resnet.__dict__:
-        model = sew_resnet.__dict__[args.model](zero_init_residual=args.zero_init_residual, T=args.T, connect_f=args.connect_f)
-    elif args.model in spiking_resnet.__dict__:
-        model = spiking_resnet.__dict__[args.model](zero_init_residual=args.zero_init_residual, T=args.T)
-    else:
-        raise NotImplementedError(args.model)
+    model = create_model(args)
 
     print(model)
 
@@ -262,25 +459,35 @@ def main(args):
 
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        # DDP on cpu with gloo takes no device_ids
+        device_ids = [args.gpu] if device.type == 'cuda' else None
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
         model_without_ddp = model.module
 
-    if args.resume:
-        checkpoint = torch.load(args.resume, map_location='cpu')
+    if checkpoint is not None:
         model_without_ddp.load_state_dict(checkpoint['model'])
         optimizer.load_state_dict(checkpoint['optimizer'])
         lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
-
-        args.start_epoch = checkpoint['epoch'] + 1
+        if args.elastic:
+            scale_lr(optimizer, lr_scheduler, args.lr_scale)
+        if scaler is not None and 'scaler' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler'])
+        if 'rng' in checkpoint:
+            utils.set_rng_state(checkpoint['rng'])
+
+        if 'sampler' in checkpoint:
+            # saved in the middle of the epoch, which goes on from the first sample that is not trained
+            train_sampler.load_state_dict(checkpoint['sampler'])
+            args.start_epoch = checkpoint['epoch']
+        else:
+            args.start_epoch = checkpoint['epoch'] + 1
 
         max_test_acc1 = checkpoint['max_test_acc1']
         test_acc5_at_max_test_acc1 = checkpoint['test_acc5_at_max_test_acc1']
 
-    if args.test_only:
-        evaluate(model, criterion, data_loader_test, device=device, header='Test:')
-        return
-
     if args.tb and utils.is_main_process():
+        # imported here, so --test-only and the scripts that import this file do not load tensorboard
+        from torch.utils.tensorboard import SummaryWriter
         purge_step_train = args.start_epoch
         purge_step_te = args.start_epoch
         train_tb_writer = SummaryWriter(output_dir + '_logs/train', purge_step=purge_step_train)
@@ -290,50 +497,104 @@ def main(args):
 
         print(f'purge_step_train={purge_step_train}, purge_step_te={purge_step_te}')
 
+    checkpoint_writer = utils.CheckpointWriter(output_dir, args.keep_checkpoints)
+
+    def get_checkpoint(epoch, steps=None):
+        checkpoint = {
+            'model': model_without_ddp.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'epoch': epoch,
+            'args': args,
+            'max_test_acc1': max_test_acc1,
+            'test_acc5_at_max_test_acc1': test_acc5_at_max_test_acc1,
+            'rng': utils.get_rng_state(),
+            # the batch size and world size that the learning rate of the optimizer is for
+            'batch_size': args.batch_size,
+            'world_size': utils.get_world_size(),
+        }
+        if scaler is not None:
+            checkpoint['scaler'] = scaler.state_dict()
+        if steps is not None:
+            checkpoint['sampler'] = train_sampler.state_dict(steps * args.batch_size)
+        return checkpoint
+
+    last_step_save = time.time()
+
+    def save_step(epoch, steps, metric_logger):
+        # overwrite checkpoint_latest.pth every args.checkpoint_minutes in an epoch
+        nonlocal last_step_save
+        if not utils.is_main_process() or time.time() - last_step_save < args.checkpoint_minutes * 60:
+            return
+        # the losses are read back only every print_freq steps, so check that the weights are not from a NaN loss
+        metric_logger.check_nan()
+        checkpoint_writer.save(get_checkpoint(epoch, steps), ['checkpoint_latest.pth'])
+        last_step_save = time.time()
+
+    async_evaluator = None
+    if args.async_eval and utils.is_main_process():
+        async_evaluator = AsyncEvaluator(args)
+    if utils.is_main_process():
+        # the checkpoints that a previous run left unevaluated. The newest one is evaluated and the others are removed
+        leftovers = sorted(glob.glob(os.path.join(output_dir, 'checkpoint_eval_*.pth')),
+                           key=lambda path: int(os.path.basename(path)[len('checkpoint_eval_'): -len('.pth')]))
+        if async_evaluator is not None and len(leftovers) > 0:
+            async_evaluator.submit([leftovers.pop()])
+        for path in leftovers:
+            os.remove(path)
+
+    def record_async_results(block=False):
+        # the metrics of the checkpoints that are evaluated by async_evaluator
+        nonlocal max_test_acc1, test_acc5_at_max_test_acc1
+        for epoch, path, test_loss, test_acc1, test_acc5 in async_evaluator.results(block):
+            if te_tb_writer is not None:
+                te_tb_writer.add_scalar('test_loss', test_loss, epoch)
+                te_tb_writer.add_scalar('test_acc1', test_acc1, epoch)
+                te_tb_writer.add_scalar('test_acc5', test_acc5, epoch)
+            if max_test_acc1 < test_acc1:
+                max_test_acc1 = test_acc1
+                test_acc5_at_max_test_acc1 = test_acc5
+                utils.link_or_copy(path, os.path.join(output_dir, 'checkpoint_max_test_acc1.pth'))
+            os.remove(path)
+
     print("Start training")
     start_time = time.time()
     for epoch in range(args.start_epoch, args.epochs):
         save_max = False
-        if args.distributed:
-            train_sampler.set_epoch(epoch)
-        train_loss, train_acc1, train_acc5 = train_one_epoch(model, criterion, optimizer, data_loader, device, epoch, args.print_freq, scaler)
+        train_sampler.set_epoch(epoch)
+        train_loss, train_acc1, train_acc5 = train_one_epoch(model, criterion, optimizer, data_loader, device, epoch,
+                                                             args.print_freq, scaler,
+                                                             save_step if args.checkpoint_minutes > 0 else None)
         if utils.is_main_process():
             train_tb_writer.add_scalar('train_loss', train_loss, epoch)
             train_tb_writer.add_scalar('train_acc1', train_acc1, epoch)
             train_tb_writer.add_scalar('train_acc5', train_acc5, epoch)
         lr_scheduler.step()
 
-        test_loss, test_acc1, test_acc5 = evaluate(model, criterion, data_loader_test, device=device, header='Test:')
-        if te_tb_writer is not None:
-            if utils.is_main_process():
+        if not args.async_eval:
+            test_loss, test_acc1, test_acc5 = evaluate(model, criterion, data_loader_test, device=device, header='Test:')
+            if te_tb_writer is not None:
+                if utils.is_main_process():
 
-                te_tb_writer.add_scalar('test_loss', test_loss, epoch)
-                te_tb_writer.add_scalar('test_acc1', test_acc1, epoch)
-                te_tb_writer.add_scalar('test_acc5', test_acc5, epoch)
+                    te_tb_writer.add_scalar('test_loss', test_loss, epoch)
+                    te_tb_writer.add_scalar('test_acc1', test_acc1, epoch)
+                    te_tb_writer.add_scalar('test_acc5', test_acc5, epoch)
 
 
-        if max_test_acc1 < test_acc1:
-            max_test_acc1 = test_acc1
-            test_acc5_at_max_test_acc1 = test_acc5
-            save_max = True
+            if max_test_acc1 < test_acc1:
+                max_test_acc1 = test_acc1
+                test_acc5_at_max_test_acc1 = test_acc5
+                save_max = True
+        elif async_evaluator is not None:
+            record_async_results()
 
 
 
         if output_dir:
 
-            checkpoint = {
-                'model': model_without_ddp.state_dict(),
-                'optimizer': optimizer.state_dict(),
-                'lr_scheduler': lr_scheduler.state_dict(),
-                'epoch': epoch,
-                'args': args,
-                'max_test_acc1': max_test_acc1,
-                'test_acc5_at_max_test_acc1': test_acc5_at_max_test_acc1,
-            }
-
-            utils.save_on_master(
-                checkpoint,
-                os.path.join(output_dir, 'checkpoint_latest.pth'))
+            checkpoint = get_checkpoint(epoch)
+
+            checkpoint_names = ['checkpoint_latest.pth']
             save_flag = False
 
             if epoch % 64 == 0 or epoch == args.epochs - 1:
@@ -346,14 +607,18 @@ def main(args):
                         break
 
             if save_flag:
-                utils.save_on_master(
-                    checkpoint,
-                    os.path.join(output_dir, f'checkpoint_{epoch}.pth'))
+                checkpoint_names.append(f'checkpoint_{epoch}.pth')
 
             if save_max:
-                utils.save_on_master(
-                    checkpoint,
-                    os.path.join(output_dir, 'checkpoint_max_test_acc1.pth'))
+                checkpoint_names.append('checkpoint_max_test_acc1.pth')
+
+            # written once in the background, and the other names are hard links of the same file
+            if async_evaluator is not None:
+                # a link kept until the checkpoint is evaluated, which updates checkpoint_max_test_acc1.pth
+                checkpoint_names.append(f'checkpoint_eval_{epoch}.pth')
+                checkpoint_writer.save(checkpoint, checkpoint_names, async_evaluator.submit)
+            else:
+                checkpoint_writer.save(checkpoint, checkpoint_names)
         print(args)
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -361,6 +626,11 @@ def main(args):
 
         print('Training time {}'.format(total_time_str), 'max_test_acc1', max_test_acc1,
               'test_acc5_at_max_test_acc1', test_acc5_at_max_test_acc1)
+    checkpoint_writer.close()
+    if async_evaluator is not None:
+        async_evaluator.close()
+        record_async_results(block=True)
+        print('max_test_acc1', max_test_acc1, 'test_acc5_at_max_test_acc1', test_acc5_at_max_test_acc1)
 
 def parse_args():
     parser = argparse.ArgumentParser(description='PyTorch Classification Training')
@@ -370,6 +640,8 @@ def parse_args():
     parser.add_argument('--model', default='resnet18', help='model')
     parser.add_argument('--device', default='cuda', help='device')
     parser.add_argument('-b', '--batch-size', default=32, type=int)
+    parser.add_argument('--eval-batch-size', default=None, type=int,
+                        help='batch size of the evaluation (default: --batch-size)')
     parser.add_argument('--epochs', default=320, type=int, metavar='N',
                         help='number of total epochs to run')
     parser.add_argument('-j', '--workers', default=16, type=int, metavar='N',
@@ -417,6 +689,25 @@ def parse_args():
 
     parser.add_argument('--tb', action='store_true',
                         help='Use TensorBoard to record logs')
+    parser.add_argument('--keep-checkpoints', default=None, type=int, metavar='N',
+                        help='keep only the newest N checkpoint_{epoch}.pth (default: keep all)')
+    parser.add_argument('--async-eval', action='store_true',
+                        help='evaluate the checkpoint of every epoch in another process while the training goes on. A '
+                             'checkpoint is skipped if a newer one is saved before its evaluation starts')
+    parser.add_argument('--async-eval-device', default='cpu', help='device of --async-eval')
+    parser.add_argument('--async-eval-threads', default=0, type=int, metavar='N',
+                        help='reserve the last N cpus for the process of --async-eval, which uses N threads, and '
+                             'pin the training processes on cpu to the other cpus (default: 0, not pinned)')
+    parser.add_argument('--elastic', action='store_true',
+                        help='resume from checkpoint_latest.pth of the output dir if it exists, e.g., when torchrun '
+                             'restarts the processes at another world size. The remaining samples of the epoch are '
+                             'split among the new processes')
+    parser.add_argument('--elastic-policy', default='linear', choices=['linear', 'global', 'none'],
+                        help='how --elastic adapts to a new world size. linear: keep -b and scale the lr linearly with '
+                             'the world size; global: keep the global batch size and the lr; none: keep both')
+    parser.add_argument('--checkpoint-minutes', default=0., type=float,
+                        help='also save checkpoint_latest.pth every this many minutes in an epoch, which --resume '
+                             'continues from the next step (default: 0, only at the end of an epoch)')
     parser.add_argument('--T', default=4, type=int, help='simulation steps')
     parser.add_argument('--adam', action='store_true',
                         help='Use Adam. The default optimizer is SGD.')
@@ -438,6 +729,10 @@ if __name__ == "__main__":
 
 python m torch.distributed.launch --nproc_per_node=8 --use_env train.py --cos_lr_T 320 --model sew_resnet18 -b 32 --output-dir ./logs --tb --print-freq 4096 --amp --cache-dataset --connect_f ADD --T 4 --lr 0.1 --epoch 320 --data-path /raid/wfang/imagenet
 
+torchrun --nnodes=1:4 --nproc_per_node=2 --max-restarts=100 --rdzv-backend=c10d --rdzv-endpoint=$HOST:29400 train.py --device cpu --elastic --checkpoint-minutes 10 --cos_lr_T 320 --model sew_resnet18 -b 32 --output-dir ./logs --tb --print-freq 4096 --cache-dataset --connect_f ADD --T 4 --lr 0.1 --epoch 320 --data-path /raid/wfang/imagenet
+
+torchrun --nproc_per_node=2 train.py --device cpu --cos_lr_T 320 --model sew_resnet18 -b 32 --output-dir ./logs --tb --print-freq 4096 --cache-dataset --connect_f ADD --T 4 --lr 0.1 --epoch 320 --data-path /raid/wfang/imagenet
+
 python train.py --cos_lr_T 320 --model spiking_resnet18 -b 32 --output-dir ./logs --tb --print-freq 4096 --amp --cache-dataset --T 4 --lr 0.1 --epoch 320 --data-path /raid/wfang/imagenet --device cuda:0 --zero_init_residual
 
 